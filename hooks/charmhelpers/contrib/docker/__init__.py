@@ -1,16 +1,21 @@
 
 import os
-import subprocess
+import json
+import time
+import hashlib
+from functools import partial
 
 from charmhelpers import fetch
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
-from charmhelpers.core.services.base import ManagerCallback
-from charmhelpers.core.services.helpers import RelationContext
+from charmhelpers.core.services.base import ManagerCallback, ServiceNotReady
+from charmhelpers.core.services.helpers import RelationContext, tcp_probe
+from charmhelpers.contrib.docker.client import DockerClient, DockerAPIError, split_image
 
 
 def install_docker():
     fetch.apt_install(['docker.io'])
+    fetch.apt_commit()  # The package must be in place before it's set up.
     if os.path.exists('/usr/local/bin/docker'):
         os.unlink('/usr/local/bin/docker')
     os.symlink('/usr/bin/docker.io', '/usr/local/bin/docker')
@@ -25,13 +30,146 @@ def install_docker_unstable():
     fetch.apt_install(['lxc-docker'])
 
 
-def docker_pull(container_name):
-    subprocess.check_call(['docker', 'pull', container_name])
+@hookenv.cached
+def docker_client():
+    """
+    The `DockerClient` shared by the helpers in this module.
+    """
+    return DockerClient()
+
+
+def image_ref(image, digest=None):
+    """
+    Return `image` pinned to `digest` (`'sha256:...'`), if one is given.
+    """
+    if not digest:
+        return image
+    repo, _ = split_image(image)
+    return '{}@{}'.format(repo, digest)
+
+
+def image_digests(image):
+    """
+    Return the repository digests of the local copy of `image`, or None if
+    the image is not present locally.
+    """
+    try:
+        info = docker_client().inspect_image(image)
+    except DockerAPIError as e:
+        if e.status == 404:
+            return None
+        raise
+    return info.get('RepoDigests') or []
+
+
+def _pull_one(image):
+    layers = {}
+    start = time.time()
+    status = None
+    for progress in DockerClient().pull(image):
+        status = progress.get('status', status)
+        layer = progress.get('id')
+        if not layer or layer == split_image(image)[1]:
+            continue
+        started = layers.setdefault(layer, time.time())
+        if status in ('Download complete', 'Pull complete', 'Already exists'):
+            hookenv.log('Pulling {}: layer {} {} after {:.1f}s'.format(
+                image, layer, status.lower(), time.time() - started),
+                hookenv.DEBUG)
+    hookenv.log('Pulled {} ({} layers) in {:.1f}s: {}'.format(
+        image, len(layers), time.time() - start, status))
+
+
+def docker_pull(images, workers=None):
+    """
+    Pull one or more images, concurrently.
+
+    Images pinned by digest (`'repo@sha256:...'`, see `image_ref`) are
+    skipped if the local copy already has that digest.  Per-layer progress
+    and timings are logged as each pull proceeds.
+    """
+    if isinstance(images, basestring):
+        images = [images]
+    wanted = []
+    for image in images:
+        if '@' in image and image in (image_digests(image) or []):
+            hookenv.log('Image {} is already present; not pulling'.format(image))
+        else:
+            wanted.append(image)
+    hookenv.map_concurrently(_pull_one, wanted, workers)
+
+
+def container_address(manager, service_name):
+    """
+    Return the IP address of the service's container, for use as the `host`
+    of a `ReadinessCallback`, so that the container itself is probed on its
+    own ports rather than through Docker's proxy on the published ones.
+    """
+    container_id = manager.state.get(service_name, 'container_id')
+    address = None
+    if container_id:
+        try:
+            info = docker_client().inspect_container(container_id)
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+        else:
+            address = info.get('NetworkSettings', {}).get('IPAddress')
+    if not address:
+        raise ServiceNotReady('{} has no running container'.format(service_name))
+    return address
+
+
+def container_running(container_id):
+    """
+    Determine whether the given container exists and is running.
+    """
+    try:
+        info = docker_client().inspect_container(container_id)
+    except DockerAPIError as e:
+        if e.status == 404:
+            return False
+        raise
+    return bool(info['State']['Running'])
+
+
+def run_config(spec):
+    """
+    Translate a run spec, as built by `DockerCallback.get_run_spec`, into
+    keyword arguments for `DockerClient.create_container`.
+    """
+    config = {
+        'image': spec['image'],
+        'command': spec['args'],
+        'exposed_ports': [],
+        'volumes': [],
+        'binds': [],
+        'port_bindings': {},
+    }
+    args = iter(spec['volumes'] + spec['ports'])
+    for flag in args:
+        value = next(args)
+        if flag == '-p':
+            host_port, container_port = value.rsplit(':', 1)
+            if '/' not in container_port:
+                container_port += '/tcp'
+            config['exposed_ports'].append(container_port)
+            config['port_bindings'][container_port] = host_port
+        elif flag == '-v' and ':' in value:
+            config['binds'].append(value)
+        elif flag == '-v':
+            config['volumes'].append(value)
+        elif flag == '--name':
+            config['name'] = value
+        else:
+            raise ValueError('Unsupported docker run flag: {}'.format(flag))
+    return config
 
 
 class DockerCallback(ManagerCallback):
     """
-    ServiceManager callback to manage starting up a Docker container.
+    ServiceManager callback to manage starting up a Docker container, using
+    the Docker Engine API.
 
     Can be referenced as `docker_start` or `docker_stop`, and performs
     the appropriate action.  Requires one or more of `DockerPortMappings`,
@@ -59,26 +197,193 @@ class DockerCallback(ManagerCallback):
             'start': docker_start,
             'stop': docker_stop,
         }])
+
+    The image run is the service name, unless the service definition gives an
+    `image` (for instance one pinned with `image_ref`); it is pulled first if
+    it is not present locally.
+
+    On `start`, the full run spec (image, port, volume and container args) is
+    fingerprinted and recorded in the manager's state, next to the container
+    id.  If the fingerprint matches the recorded one and the container is still
+    running, it is left alone; otherwise the container is replaced through
+    `host.restart_queue`, which logs the reason and runs the replacement once,
+    at the end of the hook or when a `ReadinessCallback` first needs it.
+
+    If the only arguments that changed come from `DockerRelation` items that
+    support `hot_reconfigure`, each of them is first asked to apply the change
+    to the running container through its `reconfigure` method, and the
+    container is only restarted if one of them cannot.
     """
     def __call__(self, manager, service_name, event_name):
-        container_id_file = os.path.join(hookenv.charm_dir(), 'CONTAINER_ID')
-        if os.path.exists(container_id_file):
-            container_id = host.read_file(container_id_file)
-            subprocess.check_call(['docker', 'stop', container_id])
-            os.remove(container_id_file)
+        state = manager.state
+        self._migrate_legacy_state(manager, service_name)
         if event_name == 'start':
-            subprocess.check_call(
-                ['docker', 'run', '-d', '--cidfile', container_id_file] +
-                self.get_volume_args(manager, service_name) +
-                self.get_port_args(manager, service_name) +
-                [service_name] +
-                self.get_container_args(manager, service_name))
-
-    def _get_args(self, manager, service_name, arg_type):
+            container_id = state.get(service_name, 'container_id')
+            spec = self.get_run_spec(manager, service_name)
+            recorded = state.get(service_name, 'container_spec')
+            reason, spec_changed = self.restart_reason(container_id, recorded, spec)
+            if reason is None:
+                hookenv.log('Container for {} is running with an unchanged '
+                            'spec; not restarting'.format(service_name))
+                return
+            if spec_changed and self.reconfigure(manager, service_name, recorded, spec):
+                state.set(service_name, 'container_spec', self.record_spec(spec))
+                return
+            host.restart_queue.enqueue(
+                service_name, 'docker: {}'.format(reason),
+                restart=partial(self.restart, manager, service_name, spec))
+            return
+        host.restart_queue.cancel(service_name)
+        self.stop(manager, service_name)
+
+    def stop(self, manager, service_name):
+        """
+        Stop the service's container, if it is running, and forget it.
+        """
+        state = manager.state
+        container_id = state.get(service_name, 'container_id')
+        if container_id:
+            if container_running(container_id):
+                docker_client().stop_container(container_id)
+            state.delete(service_name, 'container_id')
+        state.delete(service_name, 'container_spec')
+
+    def restart(self, manager, service_name, spec):
+        """
+        Replace the service's container with one started from `spec`.
+
+        This is queued on `host.restart_queue` by a `start` event, so it runs
+        once, at the end of the hook, unless a `ReadinessCallback` runs it
+        earlier.
+        """
+        self.stop(manager, service_name)
+        if image_digests(spec['image']) is None:
+            docker_pull(spec['image'])
+        client = docker_client()
+        container_id = client.create_container(**run_config(spec))
+        client.start_container(container_id)
+        manager.state.set(service_name, 'container_id', container_id)
+        manager.state.set(service_name, 'container_spec', self.record_spec(spec))
+
+    def _migrate_legacy_state(self, manager, service_name):
+        """
+        Take over the `CONTAINER_ID` and `CONTAINER_SPEC` files written by
+        earlier versions.
+        """
+        container_id_file = os.path.join(hookenv.charm_dir(), 'CONTAINER_ID')
+        spec_file = os.path.join(hookenv.charm_dir(), 'CONTAINER_SPEC')
+        if not os.path.exists(container_id_file):
+            return
+        if manager.state.get(service_name, 'container_id') is None:
+            manager.state.set(service_name, 'container_id',
+                              host.read_file(container_id_file).strip())
+            if os.path.exists(spec_file):
+                with open(spec_file) as fp:
+                    manager.state.set(service_name, 'container_spec', json.load(fp))
+        manager.state.replaces(container_id_file)
+        manager.state.replaces(spec_file)
+
+    def get_run_spec(self, manager, service_name):
+        """
+        Return the full set of arguments that go into `docker run`, along with
+        the static part of the container args (those that cannot be hot
+        reconfigured) and the units chosen by each hot reconfigurable relation.
+        """
+        service = manager.get_service(service_name)
+        hot = self._hot_relations(manager, service_name)
+        return {
+            'image': service.get('image', service_name),
+            'volumes': self.get_volume_args(manager, service_name),
+            'ports': self.get_port_args(manager, service_name),
+            'args': self.get_container_args(manager, service_name),
+            'static_args': self._get_args(manager, service_name,
+                                          DockerContainerArgs, exclude=hot),
+            'hot_units': dict(
+                (relation.name, [unit for unit, _ in relation.selected_units()])
+                for relation in hot),
+        }
+
+    def fingerprint(self, spec, static=False):
+        args_key = 'static_args' if static else 'args'
+        fingerprinted = {
+            'image': spec['image'],
+            'volumes': spec['volumes'],
+            'ports': spec['ports'],
+            'args': spec[args_key],
+        }
+        return hashlib.sha1(json.dumps(fingerprinted, sort_keys=True)).hexdigest()
+
+    def record_spec(self, spec):
+        """
+        Return the record of `spec` kept in the manager's state.
+        """
+        return {'fingerprint': self.fingerprint(spec),
+                'static_fingerprint': self.fingerprint(spec, static=True),
+                'spec': spec}
+
+    def restart_reason(self, container_id, recorded, spec):
+        """
+        Return `(reason, spec_changed)`, where `reason` is why the container
+        needs to be (re)started, or None if the running container already
+        matches `spec`, and `spec_changed` is True only if the container is
+        running and its recorded spec differs from `spec`.
+        """
+        if not container_id:
+            return 'no container recorded', False
+        if not container_running(container_id):
+            return 'container {} is not running'.format(container_id[:12]), False
+        if recorded is None:
+            return 'no run spec recorded', False
+        if recorded.get('fingerprint') == self.fingerprint(spec):
+            return None, False
+        old_spec = recorded.get('spec', {})
+        changed = sorted(key for key in ('image', 'volumes', 'ports', 'args')
+                         if json.dumps(spec[key]) != json.dumps(old_spec.get(key)))
+        return 'run spec changed ({})'.format(', '.join(changed) or 'fingerprint'), True
+
+    def reconfigure(self, manager, service_name, recorded, spec):
+        """
+        Try to apply a change in the hot reconfigurable relations to the
+        running container.  Returns True if the container can be left running,
+        which is only the case if at least one hot relation took a change.
+
+        Only called once `restart_reason` has found a running container whose
+        recorded spec differs from `spec`.
+        """
+        if recorded is None or 'static_fingerprint' not in recorded:
+            return False
+        if recorded['static_fingerprint'] != self.fingerprint(spec, static=True):
+            return False
+        old_units = recorded['spec'].get('hot_units', {})
+        reconfigured = False
+        for relation in self._hot_relations(manager, service_name):
+            previous = set(old_units.get(relation.name, []))
+            selected = relation.selected_units()
+            added = [unit for unit in selected if unit[0] not in previous]
+            removed = sorted(previous - set(unit for unit, _ in selected))
+            if not (added or removed):
+                continue
+            if not relation.reconfigure(added, removed):
+                hookenv.log('Could not reconfigure {} on {} in place'.format(
+                    relation.name, service_name))
+                return False
+            hookenv.log('Reconfigured {} on {} without a restart: {} added, '
+                        '{} removed'.format(relation.name, service_name,
+                                            len(added), len(removed)))
+            reconfigured = True
+        return reconfigured
+
+    def _hot_relations(self, manager, service_name):
+        service = manager.get_service(service_name)
+        return [provider for provider in service['required_data']
+                if isinstance(provider, DockerRelation) and provider.hot_reconfigure]
+
+    def _get_args(self, manager, service_name, arg_type, exclude=()):
         args = []
         service = manager.get_service(service_name)
         for provider in service['required_data']:
-            if isinstance(provider, arg_type):
+            if isinstance(provider, arg_type) and \
+                    not any(provider is excluded for excluded in exclude):
                 args.extend(provider.build_args())
         return args
 
@@ -150,23 +455,98 @@ class DockerContainerArgs(object):
 
         If you need to run a specific command other than the container default, it
         should be the first argument.
+
+        Any argument or value may be a callable, which is called with no arguments
+        when the args are built, so that values that need a hook tool to look up
+        are only fetched when the container is actually started.
         """
         self.args = list(args)
         for key, value in kwargs.iteritems():
             self.args.extend(['--'+key.replace('_', '-'), value])
 
     def build_args(self):
-        return self.args
+        return [arg() if callable(arg) else arg for arg in self.args]
+
+    def fingerprint(self):
+        return self.build_args()
+
+
+class RendezvousJoin(object):
+    """
+    Join strategy for a `DockerRelation` that picks a bounded, stable subset
+    of the related units.
+
+    Units are ranked by hashing their name together with the local unit's
+    name (rendezvous hashing), and the first `limit` are chosen.  Every unit
+    thus picks its own stable subset, spreading the joins across the peers,
+    and a peer coming or going only affects the units that ranked it.
+
+    If `probe_port` is given, candidates are checked in rank order, a few at
+    a time and concurrently, by calling `probe` with their `address_key`
+    address, the port and `probe_timeout`, and units which don't answer are
+    passed over.  If no candidate answers, the unprobed ranking is used so
+    that a cluster starting up all at once can still form.
+
+    The default `probe` only makes a TCP connection, which Docker's proxy
+    accepts for a published port even while nothing in the container is
+    listening; pass a probe that speaks the service's protocol to be sure
+    that the peer itself answers.
+    """
+    def __init__(self, limit=3, probe_port=None, probe_timeout=1,
+                 address_key='private-address', probe=tcp_probe):
+        self.limit = limit
+        self.probe_port = probe_port
+        self.probe_timeout = probe_timeout
+        self.address_key = address_key
+        self.probe = probe
+
+    def rank(self, units):
+        local_unit = hookenv.local_unit()
+        return sorted(units, reverse=True, key=lambda unit: hashlib.md5(
+            '{}:{}'.format(local_unit, unit[0])).hexdigest())
+
+    def __call__(self, units):
+        """
+        Select from a list of `(unit_name, relation_settings)` pairs.
+        """
+        ranked = self.rank(units)
+        if not self.probe_port:
+            return ranked[:self.limit]
+        live = []
+        window = self.limit * 2
+        for start in range(0, len(ranked), window):
+            candidates = ranked[start:start + window]
+            alive = hookenv.map_concurrently(
+                lambda unit: self.probe(unit[1][self.address_key],
+                                        self.probe_port, self.probe_timeout),
+                candidates)
+            live.extend(unit for unit, ok in zip(candidates, alive) if ok)
+            if len(live) >= self.limit:
+                break
+        if not live:
+            hookenv.log('No peers answered on port {}; joining {} unprobed'.format(
+                self.probe_port, min(self.limit, len(ranked))))
+            return ranked[:self.limit]
+        return live[:self.limit]
 
 
 class DockerRelation(RelationContext, DockerContainerArgs):
     """
     Class representing a relation to another Docker container, which could be
     another service, or a peer within the same service.
+
+    By default every related unit contributes arguments.  Set `join_strategy`
+    to a callable, such as `RendezvousJoin`, to choose which units do from a
+    list of `(unit_name, relation_settings)` pairs.
+
+    Subclasses that can apply a change in the chosen units to a running
+    container set `hot_reconfigure` and implement `reconfigure`.
     """
     name = None
     interface = None
     required_keys = []
+    join_strategy = None
+    hot_reconfigure = False
 
     def map(self, relation_settings):
         """
@@ -201,12 +581,34 @@ class DockerRelation(RelationContext, DockerContainerArgs):
             args.extend(['--{}'.format(key), str(value)])
         return args
 
+    def selected_units(self):
+        """
+        The `(unit_name, relation_settings)` pairs that contribute arguments.
+        """
+        if getattr(self, '_selected_units', None) is None:
+            units = zip(self.units, self.get(self.name, []))
+            if self.join_strategy is not None:
+                units = self.join_strategy(units)
+            self._selected_units = units
+        return self._selected_units
+
     def build_args(self):
         args = []
-        for unit in self.get(self.name, []):
-            args.extend(self.map(unit))
+        for unit_name, relation_settings in self.selected_units():
+            args.extend(self.map(relation_settings))
         return args
 
+    def reconfigure(self, added, removed):
+        """
+        Apply a change in the selected units to the running container, without
+        restarting it.  `added` is a list of `(unit_name, relation_settings)`
+        pairs, and `removed` a list of unit names.
+
+        Returns True on success; the default implementation cannot, and
+        returns False so that the container is restarted instead.
+        """
+        return False
+
 
 # Convenience aliases for Docker
 docker_start = docker_stop = DockerCallback()
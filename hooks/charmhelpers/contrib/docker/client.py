@@ -0,0 +1,335 @@
+"""Minimal Docker Engine API client speaking HTTP over the daemon's unix socket"""
+
+import os
+import json
+import socket
+import struct
+import httplib
+import threading
+import urllib
+
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = '1.24'  # The newest API version this client speaks.
+MIN_API_VERSION = '1.12'  # The oldest; daemons before it don't report one.
+HOST_CONFIG_ON_CREATE = '1.15'  # Before this, HostConfig is passed to start.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class DockerAPIError(Exception):
+    """Raised when the Docker daemon returns an error"""
+    def __init__(self, status, reason, body=''):
+        super(DockerAPIError, self).__init__(
+            '{} {}: {}'.format(status, reason, body.strip()))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class DockerVersionError(Exception):
+    """Raised when the Docker daemon's API is too old for this client"""
+    pass
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """`httplib.HTTPConnection` over a unix domain socket"""
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def default_socket_path():
+    """
+    The daemon socket, taken from `DOCKER_HOST` if that names a unix socket.
+    """
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return DEFAULT_SOCKET
+
+
+def _version_tuple(version):
+    return tuple(int(part) for part in version.split('.'))
+
+
+def split_image(image):
+    """
+    Split an image reference into its repository and its tag or digest.
+
+    For example, `'dockerfile/rethinkdb:latest'` becomes
+    `('dockerfile/rethinkdb', 'latest')`, and an image without a tag becomes
+    `('dockerfile/rethinkdb', None)`.
+    """
+    if '@' in image:
+        return tuple(image.split('@', 1))
+    repo, _, tag = image.rpartition(':')
+    if repo and '/' not in tag:
+        return repo, tag
+    return image, None
+
+
+class DockerClient(object):
+    """
+    Client for the Docker Engine remote API.
+
+    A single HTTP connection to the daemon socket is kept open and reused for
+    every request, so requests from different threads are made one at a
+    time.  Streaming endpoints (`pull` and `logs`) return generators which
+    hold the connection until they are exhausted or closed.
+
+    Unless a `version` is given, the API version used is the lower of the
+    daemon's, read from the unversioned `/version` endpoint before the first
+    request, and `API_VERSION`.  With daemons older than API 1.15, which
+    ignore the host config given to `create_container`, it is sent when the
+    container is started instead.
+
+    The socket path can be pointed at any server that speaks the API, such as
+    a local stand-in for tests.
+    """
+    def __init__(self, socket_path=None, version=None, timeout=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.version = version
+        self.timeout = timeout
+        self._conn = None
+        self._reused = False
+        self._host_configs = {}
+        self._lock = threading.RLock()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def negotiate_version(self):
+        """
+        Return the lower of the daemon's API version and `API_VERSION`.
+
+        Raises `DockerVersionError` if the daemon's API is older than
+        `MIN_API_VERSION`, or so old that it doesn't report its version.
+        """
+        info = self.version_info()
+        daemon_version = info.get('ApiVersion')
+        if daemon_version is None or \
+                _version_tuple(daemon_version) < _version_tuple(MIN_API_VERSION):
+            raise DockerVersionError(
+                'Docker {} (API {}) is too old; API {} or later is '
+                'required'.format(info.get('Version', 'unknown'),
+                                  daemon_version or 'unknown', MIN_API_VERSION))
+        return min(daemon_version, API_VERSION, key=_version_tuple)
+
+    def api_version(self):
+        """The API version in use, negotiated on first use"""
+        if self.version is None:
+            self.version = self.negotiate_version()
+        return self.version
+
+    def _url(self, path, params=None, versioned=True):
+        url = path
+        if versioned:
+            url = '/v{}{}'.format(self.api_version(), path)
+        if params:
+            url += '?' + urllib.urlencode(params)
+        return url
+
+    def _request(self, method, path, params=None, body=None, versioned=True):
+        """
+        Make a request and return the response, which the caller must read
+        while holding `_lock`.
+        """
+        url = self._url(path, params, versioned)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        while True:
+            if self._conn is None:
+                self._conn = UnixHTTPConnection(self.socket_path, self.timeout)
+                self._reused = False
+            reused, sent = self._reused, False
+            try:
+                self._conn.request(method, url, body, headers)
+                sent = True
+                response = self._conn.getresponse()
+            except socket.timeout:
+                self.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                self.close()
+                # A persistent connection that the daemon has since closed
+                # fails before any response.  Only then is the request tried
+                # again on a fresh connection, and, if it was already sent,
+                # only if repeating it is harmless.
+                if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                continue
+            self._reused = True
+            break
+        if response.status >= 400:
+            raise DockerAPIError(response.status, response.reason,
+                                 response.read())
+        return response
+
+    def _json(self, method, path, params=None, body=None, versioned=True):
+        with self._lock:
+            data = self._request(method, path, params, body, versioned).read()
+        if data:
+            return json.loads(data)
+        return None
+
+    def _chunks(self, response):
+        """
+        Yield the body of a response as it arrives.  Chunked bodies are
+        decoded here, one chunk at a time, so progress is seen as soon as the
+        daemon sends it.
+
+        If the generator is closed before the body has all been read, the
+        connection is closed too, as the rest of the body is still on it.
+        """
+        complete = False
+        try:
+            if not response.chunked:
+                while True:
+                    data = response.read(4096)
+                    if not data:
+                        complete = True
+                        return
+                    yield data
+            while True:
+                size = int(response.fp.readline().split(';', 1)[0], 16)
+                if size == 0:
+                    while response.fp.readline() not in ('\r\n', '\n', ''):
+                        pass
+                    complete = True
+                    return
+                yield response.fp.read(size)
+                response.fp.read(2)
+        finally:
+            response.close()
+            if not complete:
+                self.close()
+
+    def _stream_json(self, method, path, params=None, body=None):
+        """
+        Yield each JSON object from a streaming response.
+        """
+        decoder = json.JSONDecoder()
+        buf = ''
+        with self._lock:
+            for data in self._chunks(self._request(method, path, params, body)):
+                buf += data
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        obj, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    yield obj
+
+    def version_info(self):
+        return self._json('GET', '/version', versioned=False)
+
+    def inspect_container(self, container):
+        return self._json('GET', '/containers/{}/json'.format(container))
+
+    def inspect_image(self, image):
+        return self._json('GET', '/images/{}/json'.format(image))
+
+    def create_container(self, image, command=None, name=None,
+                         exposed_ports=None, volumes=None,
+                         binds=None, port_bindings=None):
+        """
+        Create a container and return its ID.
+
+        `exposed_ports` is a list of container ports (`'8080/tcp'`), `volumes`
+        a list of container paths, `binds` a list of `host:container` paths, and
+        `port_bindings` a mapping of container port to host port.
+        """
+        host_config = {
+            'Binds': binds or None,
+            'PortBindings': dict(
+                (port, [{'HostPort': str(host_port)}])
+                for port, host_port in (port_bindings or {}).items()),
+        }
+        body = {
+            'Image': image,
+            'Cmd': command or None,
+            'ExposedPorts': dict((port, {}) for port in exposed_ports or []),
+            'Volumes': dict((volume, {}) for volume in volumes or []),
+        }
+        on_create = _version_tuple(self.api_version()) >= \
+            _version_tuple(HOST_CONFIG_ON_CREATE)
+        if on_create:
+            body['HostConfig'] = host_config
+        params = {'name': name} if name else None
+        container = self._json('POST', '/containers/create', params, body)['Id']
+        if not on_create:
+            self._host_configs[container] = host_config
+        return container
+
+    def start_container(self, container):
+        """
+        Start a container.  With daemons older than API 1.15, the host config
+        given when it was created by this client is sent along.
+        """
+        host_config = self._host_configs.pop(container, None)
+        self._json('POST', '/containers/{}/start'.format(container),
+                   body=host_config)
+
+    def stop_container(self, container, timeout=10):
+        self._json('POST', '/containers/{}/stop'.format(container),
+                   {'t': timeout})
+
+    def wait_container(self, container):
+        """
+        Block until the container stops, and return its exit code.  Other
+        requests made with this client wait until then.
+        """
+        return self._json('POST', '/containers/{}/wait'.format(container))['StatusCode']
+
+    def remove_container(self, container, force=False):
+        self._json('DELETE', '/containers/{}'.format(container),
+                   {'force': int(force)})
+
+    def pull(self, image):
+        """
+        Pull an image, yielding each progress message from the daemon.
+
+        Raises `DockerAPIError` if the daemon reports an error mid-stream.
+        """
+        repo, tag = split_image(image)
+        params = {'fromImage': repo}
+        if tag:
+            params['tag'] = tag
+        for progress in self._stream_json('POST', '/images/create', params):
+            if 'error' in progress:
+                raise DockerAPIError(500, 'Pull failed', progress['error'])
+            yield progress
+
+    def logs(self, container, stdout=True, stderr=True, follow=False, tail='all'):
+        """
+        Yield `(stream, data)` pairs from a container's output, where `stream`
+        is 1 for stdout and 2 for stderr.
+        """
+        params = {'stdout': int(stdout), 'stderr': int(stderr),
+                  'follow': int(follow), 'tail': tail}
+        buf = ''
+        with self._lock:
+            response = self._request('GET', '/containers/{}/logs'.format(container), params)
+            for data in self._chunks(response):
+                buf += data
+                while len(buf) >= 8:
+                    stream, size = struct.unpack('>BxxxL', buf[:8])
+                    if len(buf) < 8 + size:
+                        break
+                    yield stream, buf[8:8 + size]
+                    buf = buf[8 + size:]
@@ -0,0 +1,160 @@
+"""Fast, read-only view of the packages dpkg has installed"""
+
+import os
+import mmap
+import threading
+import subprocess
+
+STATUS_FILE = '/var/lib/dpkg/status'
+
+# Package states in which dpkg has no version of the package on disk; in any
+# other state the package has a current version, as apt counts it.
+NOT_INSTALLED_STATES = ('not-installed', 'config-files')
+
+
+class DpkgStatus(object):
+    """
+    Index of the installed packages, parsed straight from the dpkg status
+    file, which is mapped into memory rather than read.
+
+    The index is built on first use, and rebuilt whenever the status file
+    changes, so it never needs to be flushed.  Packages can be looked up by
+    `name:arch`, or by bare name, which, as with apt, only finds packages of
+    the native architecture or `all`.
+    """
+    def __init__(self, path=STATUS_FILE):
+        self.path = path
+        self._key = None
+        self._versions = {}
+        self._architecture = None
+        self._lock = threading.Lock()
+
+    @property
+    def architecture(self):
+        """The native architecture, from `dpkg --print-architecture`"""
+        if self._architecture is None:
+            self._architecture = subprocess.check_output(
+                ['dpkg', '--print-architecture']).strip()
+        return self._architecture
+
+    def _index(self):
+        stat = os.stat(self.path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        with self._lock:
+            if key != self._key:
+                self._versions = self._parse()
+                self._key = key
+            return self._versions
+
+    def _parse(self):
+        versions = {}
+        native = (self.architecture, 'all')
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return versions
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start, size = 0, len(data)
+            while start < size:
+                end = data.find('\n\n', start)
+                if end == -1:
+                    end = size
+                fields = {}
+                for line in data[start:end].split('\n'):
+                    if line[:1] in ('', ' ', '\t'):
+                        continue
+                    name, _, value = line.partition(':')
+                    if name in ('Package', 'Status', 'Version', 'Architecture'):
+                        fields[name] = value.strip()
+                start = end + 2
+                status = fields.get('Status', '').split()
+                if 'Package' not in fields or 'Version' not in fields or \
+                        not status or status[-1] in NOT_INSTALLED_STATES:
+                    continue
+                package = fields['Package']
+                architecture = fields.get('Architecture', 'all')
+                if architecture in native:
+                    versions[package] = fields['Version']
+                versions['{}:{}'.format(package, architecture)] = fields['Version']
+        finally:
+            data.close()
+        return versions
+
+    def installed_version(self, package):
+        """Return the installed version of `package`, or None"""
+        return self._index().get(package)
+
+    def is_installed(self, package):
+        return self.installed_version(package) is not None
+
+
+status = DpkgStatus()
+
+
+def installed_version(package):
+    """Return the installed version of `package`, or None"""
+    return status.installed_version(package)
+
+
+def is_installed(package):
+    """Return True if dpkg has a version of `package` installed"""
+    return status.is_installed(package)
+
+
+def _order(char):
+    if char == '~':
+        return -1
+    if char.isdigit():
+        return 0
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _compare_part(a, b):
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or \
+                (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _split_version(version):
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    return int(epoch or 0), upstream, revision
+
+
+def version_compare(a, b):
+    """Compare two Debian version strings, as dpkg does
+
+    Returns 1, 0 or -1 if `a` is greater than, equal to or less than `b`.
+    """
+    epoch_a, upstream_a, revision_a = _split_version(a)
+    epoch_b, upstream_b, revision_b = _split_version(b)
+    result = cmp(epoch_a, epoch_b) or \
+        _compare_part(upstream_a, upstream_b) or \
+        _compare_part(revision_a, revision_b)
+    return cmp(result, 0)
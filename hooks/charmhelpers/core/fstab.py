@@ -30,6 +30,9 @@ class Fstab(file):
         def __eq__(self, o):
             return str(self) == str(o)
 
+        def __ne__(self, o):
+            return not self == o
+
         def __str__(self):
             return "{} {} {} {} {} {}".format(self.device,
                                               self.mountpoint,
@@ -5,11 +5,17 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 import os
+import copy
 import json
 import yaml
+import atexit as _py_atexit
 import subprocess
 import sys
+import Queue
+import threading
 import UserDict
+from collections import OrderedDict
+from functools import wraps, partial
 from subprocess import CalledProcessError
 
 CRITICAL = "CRITICAL"
@@ -18,8 +24,128 @@ WARNING = "WARNING"
 INFO = "INFO"
 DEBUG = "DEBUG"
 MARKER = object()
+RELATION_WORKERS = 8  # Maximum concurrent hook tool calls for bulk queries.
 
-cache = {}
+
+class MemoCache(object):
+    """Memoised results of hook tool calls.
+
+    Entries are keyed on hashable ``(func, args, kwargs)`` tuples and are
+    also indexed under the name of the function that produced them and
+    under each string argument (unit names, relation ids, config keys,
+    ...), so that `flush` only visits the entries that mention a token.
+
+    If `maxsize` is set, the least recently used entries are evicted once
+    the cache grows beyond it.  Hits, misses, evictions and invalidations
+    are counted and available from `stats()`.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._index = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, MemoCache._freeze(v))
+                                for k, v in value.items()))
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return tuple(MemoCache._freeze(v) for v in value)
+        return value
+
+    def make_key(self, func, args, kwargs):
+        """Build the cache key for a call of `func`"""
+        key = (func, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = (func, self._freeze(args), self._freeze(kwargs))
+        return key
+
+    @staticmethod
+    def tokens(func, args, kwargs):
+        """The index tokens for a call of `func`"""
+        tokens = set([func.__name__])
+        for value in args + tuple(kwargs.values()):
+            if isinstance(value, basestring):
+                tokens.add(value)
+        return tokens
+
+    def get(self, key):
+        """Return the value cached under `key`, or raise KeyError"""
+        with self._lock:
+            try:
+                value, tokens = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._entries[key] = (value, tokens)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, tokens=()):
+        """Cache `value` under `key`, indexed under each of `tokens`"""
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, tokens)
+            for token in tokens:
+                self._index.setdefault(token, set()).add(key)
+            while self.maxsize and len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _discard(self, key):
+        try:
+            value, tokens = self._entries.pop(key)
+        except KeyError:
+            return False
+        for token in tokens:
+            keys = self._index.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[token]
+        return True
+
+    def flush(self, token):
+        """Drop every entry indexed under `token`"""
+        with self._lock:
+            for key in list(self._index.get(token, ())):
+                if self._discard(key):
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def stats(self):
+        """Return the hit, miss, eviction and invalidation counters"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+cache = MemoCache()
+_atexit = []
+_atexit_registered = False
 
 
 def cached(func):
@@ -35,36 +161,95 @@ def cached(func):
 
     will cache the result of unit_get + 'test' for future calls.
     """
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key = cache.make_key(func, args, kwargs)
         try:
-            return cache[key]
+            return cache.get(key)
         except KeyError:
             res = func(*args, **kwargs)
-            cache[key] = res
+            cache.set(key, res, cache.tokens(func, args, kwargs))
             return res
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache where the key is the
+    name of the function or one of its string arguments"""
+    cache.flush(key)
+
+
+class LogBuffer(object):
+    """Buffer for juju log messages, written out in batches.
+
+    Messages are queued in memory and, when the buffer is flushed, written
+    with one `juju-log` call per run of consecutive messages at the same
+    level.  The buffer is flushed at the end of the hook (see `atexit`),
+    whenever `max_pending` messages are queued, and before any message at
+    one of the `sync_levels`, which are always written straight away.
+
+    Set `enabled` to False to write every message as it is logged.
+    """
+
+    def __init__(self, max_pending=100, sync_levels=(ERROR, CRITICAL)):
+        self.enabled = True
+        self.max_pending = max_pending
+        self.sync_levels = sync_levels
+        self._pending = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def write(self, message, level=None):
+        """Queue a message, flushing if required"""
+        if not self.enabled:
+            self._emit(level, [message])
+            return
+        with self._lock:
+            self._pending.append((level, message))
+            if not self._scheduled:
+                self._scheduled = True
+                atexit(self._flush_at_exit)
+            flush_now = (level in self.sync_levels or
+                         len(self._pending) >= self.max_pending)
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Write out all queued messages"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        batch_level, batch = None, []
+        for level, message in pending:
+            if batch and level != batch_level:
+                self._emit(batch_level, batch)
+                batch = []
+            batch_level = level
+            batch.append(message)
+        if batch:
+            self._emit(batch_level, batch)
+
+    def _flush_at_exit(self):
+        self._scheduled = False
+        self.flush()
+
+    def _emit(self, level, messages):
+        command = ['juju-log']
+        if level:
+            command += ['-l', level]
+        command += ['\n'.join(messages)]
+        subprocess.call(command)
+
+
+log_buffer = LogBuffer()
 
 
 def log(message, level=None):
-    """Write a message to the juju log"""
-    command = ['juju-log']
-    if level:
-        command += ['-l', level]
-    command += [message]
-    subprocess.call(command)
+    """Write a message to the juju log
+
+    Messages are batched by `log_buffer`; ERROR and CRITICAL messages are
+    written immediately, along with anything queued before them.
+    """
+    log_buffer.write(message, level)
 
 
 class Serializable(UserDict.IterableUserDict):
@@ -106,18 +291,53 @@ class Serializable(UserDict.IterableUserDict):
         return yaml.dump(self.data)
 
 
+class LazyDict(UserDict.DictMixin):
+    """A mapping whose values are computed on first lookup
+
+    `loaders` maps each key to a function, called with no arguments the
+    first time that key is looked up, which returns its value.
+    """
+
+    def __init__(self, loaders):
+        self._loaders = dict(loaders)
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            self._values[key] = self._loaders[key]()
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._loaders.setdefault(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._loaders[key]
+        self._values.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._loaders
+
+    def keys(self):
+        return self._loaders.keys()
+
+
 def execution_environment():
-    """A convenient bundling of the current execution context"""
-    context = {}
-    context['conf'] = config()
+    """A convenient bundling of the current execution context
+
+    Each value is only looked up from Juju when it is first used.
+    """
+    loaders = {
+        'conf': config,
+        'unit': local_unit,
+        'rels': relations,
+        'env': lambda: os.environ,
+    }
     if relation_id():
-        context['reltype'] = relation_type()
-        context['relid'] = relation_id()
-        context['rel'] = relation_get()
-    context['unit'] = local_unit()
-    context['rels'] = relations()
-    context['env'] = os.environ
-    return context
+        loaders['reltype'] = relation_type
+        loaders['relid'] = relation_id
+        loaders['rel'] = relation_get
+    return LazyDict(loaders)
 
 
 def in_relation_hook():
@@ -357,6 +577,126 @@ def relations_of_type(reltype=None):
     return relation_data
 
 
+class RelationSnapshot(object):
+    """A copy of remote unit relation data that is kept on disk between
+    hook invocations and updated incrementally.
+
+    Juju fires a relation hook for every change a remote unit makes, so
+    rather than re-reading every unit on every hook the snapshot only
+    re-reads the unit named by ``JUJU_REMOTE_UNIT``, and applies the
+    membership deltas signalled by ``-joined``, ``-departed`` and
+    ``-broken`` hooks.  Non-relation hooks issue no hook tool calls at all.
+
+    The whole snapshot is rebuilt when it does not exist yet, on
+    ``upgrade-charm``, and every `CHECK_INTERVAL` hooks as a consistency
+    check; any units found to have drifted are counted and logged.
+
+    Do not instantiate this object directly - instead call
+    ``hookenv.relation_snapshot()``
+    """
+    SNAPSHOT_FILE_NAME = '.juju-relation-snapshot'
+    CHECK_INTERVAL = 50
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(charm_dir(),
+                                         RelationSnapshot.SNAPSHOT_FILE_NAME)
+        self.relations = {}
+        self.hooks_since_check = 0
+        self.stats = {'hits': 0, 'refreshes': 0, 'full_refreshes': 0,
+                      'inconsistencies': 0}
+        self._loaded = False
+        if os.path.exists(self.path):
+            self.load()
+
+    def load(self):
+        """Load the snapshot from disk"""
+        with open(self.path) as f:
+            state = json.load(f)
+        self.relations = state.get('relations', {})
+        self.hooks_since_check = state.get('hooks_since_check', 0)
+        self.stats.update(state.get('stats', {}))
+        self._loaded = True
+
+    def save(self):
+        """Atomically write the snapshot to disk"""
+        log('Relation snapshot: {hits} hits, {refreshes} unit refreshes, '
+            '{full_refreshes} full refreshes, {inconsistencies} '
+            'inconsistencies'.format(**self.stats), level=DEBUG)
+        # host imports this module, so it can only be imported here.
+        from charmhelpers.core.host import write_file_atomic
+        write_file_atomic(self.path, json.dumps({
+            'relations': self.relations,
+            'hooks_since_check': self.hooks_since_check,
+            'stats': self.stats,
+        }))
+
+    def refresh(self):
+        """Rebuild the whole snapshot from the hook tools, returning the
+        number of units whose data differed from the previous snapshot"""
+        relations = relation_data(relation_types())
+        drifted = 0
+        if self._loaded:
+            for reltype, relids in relations.items():
+                for relid, units in relids.items():
+                    known = self.relations.get(reltype, {}).get(relid, {})
+                    drifted += len(set(units) ^ set(known))
+                    drifted += len([unit for unit in units
+                                    if unit in known and
+                                    units[unit] != known[unit]])
+        self.relations = relations
+        self.hooks_since_check = 0
+        self.stats['full_refreshes'] += 1
+        self.stats['inconsistencies'] += drifted
+        self._loaded = True
+        if drifted:
+            log('Relation snapshot was inconsistent for {} units'.format(
+                drifted), level=WARNING)
+        return drifted
+
+    def update(self):
+        """Bring the snapshot up to date for the currently executing hook"""
+        self.hooks_since_check += 1
+        hook = hook_name()
+        if (not self._loaded or hook == 'upgrade-charm' or
+                self.hooks_since_check >= self.CHECK_INTERVAL):
+            self.refresh()
+            return
+        relid = relation_id()
+        if relid is None:
+            return
+        relids = self.relations.setdefault(relation_type(), {})
+        if hook.endswith('-relation-broken'):
+            relids.pop(relid, None)
+            return
+        units = relids.setdefault(relid, {})
+        unit = os.environ.get('JUJU_REMOTE_UNIT')
+        if not unit:
+            return
+        if hook.endswith('-relation-departed'):
+            units.pop(unit, None)
+        else:
+            units[unit] = relation_get(unit=unit, rid=relid)
+            self.stats['refreshes'] += 1
+
+    def units(self, reltype):
+        """Return ``{relid: {unit: data}}`` for the given relation type"""
+        relids = copy.deepcopy(self.relations.get(reltype, {}))
+        self.stats['hits'] += sum(len(units) for units in relids.values())
+        return relids
+
+
+@cached
+def relation_snapshot():
+    """The persistent relation snapshot, updated for the current hook.
+
+    The snapshot is saved back to disk when the hook exits.
+    """
+    snapshot = RelationSnapshot()
+    snapshot.update()
+    atexit(snapshot.save)
+    return snapshot
+
+
 @cached
 def relation_types():
     """Get a list of relation types supported by this charm"""
@@ -372,22 +712,97 @@ def relation_types():
     return rel_types
 
 
-@cached
-def relations():
-    """Get a nested dictionary of relation data for all related units"""
+def map_concurrently(func, items, workers=None):
+    """Call `func` on each of `items` using a bounded pool of threads.
+
+    Results are returned in the same order as `items`.  If any call raises,
+    the exception for the earliest item is re-raised once all of the
+    workers have finished.
+    """
+    items = list(items)
+    workers = min(workers or RELATION_WORKERS, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+
+def relation_data(reltypes, include_local=False, workers=None):
+    """Collect the relation data of every unit on the given relation types
+
+    Each stage (`relation-ids`, `relation-list` and `relation-get`) is fanned
+    out across at most `workers` threads, so the cost of a query grows with
+    the number of stages rather than the number of related units.
+
+    Returns a nested dict of the form ``{reltype: {relid: {unit: data}}}``.
+    If `include_local` is True, the local unit's settings are included for
+    each relation id as well.
+    """
+    if isinstance(reltypes, basestring):
+        reltypes = [reltypes]
+    reltypes = list(reltypes)
+    all_relids = map_concurrently(relation_ids, reltypes, workers)
     rels = {}
-    for reltype in relation_types():
-        relids = {}
-        for relid in relation_ids(reltype):
-            units = {local_unit(): relation_get(unit=local_unit(), rid=relid)}
-            for unit in related_units(relid):
-                reldata = relation_get(unit=unit, rid=relid)
-                units[unit] = reldata
-            relids[relid] = units
-        rels[reltype] = relids
+    pairs = []
+    for reltype, relids in zip(reltypes, all_relids):
+        rels[reltype] = {}
+        for relid in relids:
+            rels[reltype][relid] = {}
+            pairs.append((reltype, relid))
+    all_units = map_concurrently(lambda pair: related_units(pair[1]),
+                                 pairs, workers)
+    targets = []
+    for (reltype, relid), units in zip(pairs, all_units):
+        if include_local:
+            targets.append((reltype, relid, local_unit()))
+        targets.extend((reltype, relid, unit) for unit in units)
+    all_data = map_concurrently(
+        lambda target: relation_get(unit=target[2], rid=target[1]),
+        targets, workers)
+    for (reltype, relid, unit), reldata in zip(targets, all_data):
+        rels[reltype][relid][unit] = reldata
     return rels
 
 
+def _relations_of(reltype):
+    return relation_data(reltype, include_local=True)[reltype]
+
+
+@cached
+def relations():
+    """Get a nested dictionary of relation data for all related units
+
+    The data for each relation type is collected when it is first used.
+    """
+    return LazyDict((reltype, partial(_relations_of, reltype))
+                    for reltype in relation_types())
+
+
 @cached
 def is_relation_made(relation, keys='private-address'):
     '''
@@ -476,7 +891,10 @@ class Hooks(object):
         """Execute a registered hook based on args[0]"""
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
-            self._hooks[hook_name]()
+            try:
+                self._hooks[hook_name]()
+            finally:
+                _run_atexit()
         else:
             raise UnregisteredHookError(hook_name)
 
@@ -497,3 +915,35 @@ class Hooks(object):
 def charm_dir():
     """Return the root directory of the current charm"""
     return os.environ.get('CHARM_DIR')
+
+
+def atexit(callback, *args, **kwargs):
+    """Schedule a callback to run at the end of the hook.
+
+    Callbacks run in reverse order of registration, once, either when
+    `Hooks.execute` or `ServiceManager.manage` finish or, failing that,
+    when the interpreter exits.
+    """
+    global _atexit_registered
+    if not _atexit_registered:
+        _py_atexit.register(_run_atexit)
+        _atexit_registered = True
+    _atexit.append((callback, args, kwargs))
+
+
+def _run_atexit():
+    """Run and clear the callbacks scheduled with `atexit`
+
+    Every callback is run even if an earlier one fails; the first error is
+    re-raised once they have all been run.
+    """
+    error = None
+    while _atexit:
+        callback, args, kwargs = _atexit.pop()
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    if error is not None:
+        raise error[0], error[1], error[2]
@@ -6,19 +6,32 @@
 #  Matthew Wedgwood <matthew.wedgwood@canonical.com>
 
 import os
+import re
 import pwd
 import grp
+import json
+import time
 import random
 import string
 import subprocess
 import hashlib
+import stat
 import shutil
+import threading
 from contextlib import contextmanager
 
 from collections import OrderedDict
 
-from hookenv import log
+from hookenv import log, charm_dir, atexit, map_concurrently
 from fstab import Fstab
+import dpkg
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+CHOWN_WORKERS = 4  # Threads walking subtrees in chownr.
 
 
 def service_start(service_name):
@@ -48,7 +61,9 @@ def service_reload(service_name, restart_on_failure=False):
 def service(action, service_name):
     """Control a system service"""
     cmd = ['service', service_name, action]
-    return subprocess.call(cmd) == 0
+    success = subprocess.call(cmd) == 0
+    service_status.update(action, service_name, success)
+    return success
 
 
 def service_running(service):
@@ -74,6 +89,105 @@ def service_available(service_name):
         return True
 
 
+class ServiceStatus(object):
+    """
+    Hook-scoped cache of which system services are available and running.
+
+    The first lookup asks the init system about every service at once,
+    through `systemctl` or upstart's `initctl list`.  Services it doesn't
+    report, such as plain SysV init scripts, fall back to a single
+    `service <name> status` each.  Actions taken through `service`
+    update the cache, so it stays correct for the rest of the hook.
+    """
+    _upstart = re.compile(r'^(\S+) (?:\(.*\) )?(\w+)/(\w+)')
+
+    def __init__(self):
+        self._status = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._status is None:
+            try:
+                if os.path.isdir('/run/systemd/system'):
+                    self._status = self._query_systemd()
+                else:
+                    self._status = self._query_upstart()
+            except (OSError, subprocess.CalledProcessError) as e:
+                log('Could not list services: {}'.format(e))
+                self._status = {}
+        return self._status
+
+    def _query_systemd(self):
+        status = {}
+        output = subprocess.check_output(
+            ['systemctl', 'list-unit-files', '--type=service', '--no-legend'])
+        for line in output.splitlines():
+            if line.strip():
+                name = line.split()[0]
+                if name.endswith('.service'):
+                    status[name[:-len('.service')]] = (True, False)
+        output = subprocess.check_output(
+            ['systemctl', 'list-units', '--type=service', '--all',
+             '--no-legend', '--plain'])
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[0].endswith('.service'):
+                name = fields[0][:-len('.service')]
+                status[name] = (fields[1] != 'not-found', fields[2] == 'active')
+        return status
+
+    def _query_upstart(self):
+        status = {}
+        output = subprocess.check_output(['initctl', 'list'])
+        for line in output.splitlines():
+            match = self._upstart.match(line)
+            if match:
+                name, goal, state = match.groups()
+                running = goal == 'start' and state == 'running'
+                status[name] = (True, running or status.get(name, (True, False))[1])
+        return status
+
+    def _get(self, service_name):
+        with self._lock:
+            status = self._load()
+            if service_name not in status:
+                status[service_name] = self._query_service(service_name)
+            return status[service_name]
+
+    def _query_service(self, service_name):
+        try:
+            output = subprocess.check_output(['service', service_name, 'status'],
+                                             stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return (False, False)
+        return (True, "start/running" in output or "is running" in output)
+
+    def available(self, service_name):
+        return self._get(service_name)[0]
+
+    def running(self, service_name):
+        return self._get(service_name)[1]
+
+    def update(self, action, service_name, success):
+        """Record the outcome of `action` on `service_name`"""
+        with self._lock:
+            if self._status is None:
+                return
+            if not success:
+                self._status.pop(service_name, None)
+            elif action in ('start', 'restart'):
+                self._status[service_name] = (True, True)
+            elif action == 'stop':
+                self._status[service_name] = (True, False)
+
+    def invalidate(self):
+        with self._lock:
+            self._status = None
+
+
+service_status = ServiceStatus()
+
+
 def adduser(username, password=None, shell='/bin/bash', system_user=False):
     """Add a user to the system"""
     try:
@@ -157,6 +271,31 @@ def write_file(path, content, owner='root', group='root', perms=0444):
         target.write(content)
 
 
+def write_file_atomic(path, content):
+    """Replace the contents of 'path' with a string, atomically and durably
+
+    The content is written to a temporary file next to 'path', synced to
+    disk and renamed over it, and the directory is then synced, so a crash
+    leaves either the old file or the new one, never a partial one.
+    """
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp_path, 'w') as target:
+            target.write(content)
+            target.flush()
+            os.fsync(target.fileno())
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def copy_file(src, dst, owner='root', group='root', perms=0444):
     """Create or overwrite a file with the contents of another file"""
     log("Writing file {} {}:{} {:o} from {}".format(dst, owner, group, perms, src))
@@ -224,15 +363,313 @@ def mounts():
     return system_mounts
 
 
-def file_hash(path):
-    """Generate a md5 hash of the contents of 'path' or None if not found """
-    if os.path.exists(path):
-        h = hashlib.md5()
-        with open(path, 'r') as source:
-            h.update(source.read())  # IGNORE:E1101 - it does have update
-        return h.hexdigest()
-    else:
+PERFORMANCE_MOUNT_OPTIONS = {
+    None: ['noatime', 'nodiratime'],
+    'ext4': ['noatime', 'nodiratime', 'commit=30'],
+    'xfs': ['noatime', 'nodiratime', 'inode64', 'logbufs=8', 'logbsize=256k'],
+    'btrfs': ['noatime', 'nodiratime', 'space_cache'],
+}
+# Options that the kernel always reports in /proc/mounts as given; others are
+# interpreted by the filesystem and may be shown differently, or not at all.
+VERIFIED_MOUNT_OPTIONS = ('ro', 'rw', 'noatime', 'nodiratime', 'relatime',
+                          'nosuid', 'nodev', 'noexec')
+
+
+def mount_options(filesystem=None, extra=None):
+    """Return the mount options for `filesystem` tuned for throughput
+
+    Access time updates are disabled everywhere, with some further tuning
+    for ext4, xfs and btrfs.  `extra` is a comma separated string of options
+    added after those.
+    """
+    options = list(PERFORMANCE_MOUNT_OPTIONS.get(filesystem,
+                                                 PERFORMANCE_MOUNT_OPTIONS[None]))
+    for option in (extra or '').split(','):
+        option = option.strip()
+        if option and option not in options:
+            options.append(option)
+    return ','.join(options)
+
+
+def mount_info(mountpoint):
+    """Return the /proc/mounts entry for `mountpoint` as a dict, or None
+
+    The dict has the `device`, `mountpoint`, `filesystem` and a list of
+    `options`.  If several filesystems are mounted there, this is the
+    topmost one.
+    """
+    mountpoint = os.path.realpath(mountpoint)
+    info = None
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 4 and fields[1] == mountpoint:
+                info = {'device': fields[0], 'mountpoint': fields[1],
+                        'filesystem': fields[2],
+                        'options': fields[3].split(',')}
+    return info
+
+
+def _mounted_from(device, mountpoint):
+    """Return True if the filesystem at `mountpoint` comes from `device`
+
+    For a block device, the mountpoint must be on that device; for a
+    directory, the mountpoint must be a bind mount of it.
+    """
+    source = os.stat(device)
+    target = os.stat(mountpoint)
+    if stat.S_ISBLK(source.st_mode):
+        return target.st_dev == source.st_rdev
+    return (target.st_dev, target.st_ino) == (source.st_dev, source.st_ino)
+
+
+def ensure_mount(device, mountpoint, filesystem=None, options=None,
+                 persist=True):
+    """Make sure `device` is mounted at `mountpoint` with `options`
+
+    `device` may be a block device, or a directory to bind mount.  If
+    `options` is None, `mount_options(filesystem)` is used.  A filesystem
+    that is already mounted there is remounted if any of the options are
+    not active, and left alone otherwise.  If something other than `device`
+    is mounted there, nothing is changed and False is returned.  With
+    `persist`, the /etc/fstab entry for the mountpoint is added, or replaced
+    if it differs.
+
+    Returns True once the mount is verified against /proc/mounts, and False
+    if it could not be made or the options did not take effect.
+    """
+    bind = os.path.isdir(device)
+    if options is None:
+        options = mount_options(None if bind else filesystem)
+    wanted = [option for option in options.split(',') if option]
+    if not os.path.isdir(mountpoint):
+        mkdir(mountpoint, perms=0755)
+
+    info = mount_info(mountpoint)
+    if info is not None and not _mounted_from(device, mountpoint):
+        log('{} is already mounted at {}, not {}'.format(
+            info['device'], mountpoint, device))
+        return False
+    if info is None:
+        if bind:
+            # Bind mounts only take their flags from a remount.
+            if not mount(device, mountpoint, options='bind'):
+                return False
+            info = mount_info(mountpoint)
+        elif not mount(device, mountpoint, options=options):
+            return False
+    if info is not None and not set(wanted) <= set(info['options']):
+        remount = ['remount', 'bind'] if bind else ['remount']
+        if not mount(device, mountpoint, options=','.join(remount + wanted)):
+            return False
+
+    if persist:
+        fs_type = 'none' if bind else filesystem
+        fs_options = ','.join((['bind'] if bind else []) + wanted)
+        entry = Fstab.Entry(device, mountpoint, fs_type, fs_options)
+        fstab = Fstab()
+        try:
+            existing = fstab.get_entry_by_attr('mountpoint', mountpoint)
+            if existing != entry:
+                if existing:
+                    fstab.remove_entry(existing)
+                fstab.add_entry(entry)
+        finally:
+            fstab.close()
+
+    info = mount_info(mountpoint)
+    if info is None:
+        log('{} is not mounted at {}'.format(device, mountpoint))
+        return False
+    active = set(info['options'])
+    missing = [option for option in wanted if option not in active]
+    if missing:
+        unverified = [option for option in missing
+                      if option not in VERIFIED_MOUNT_OPTIONS]
+        if unverified:
+            log('Mount options of {} not shown in /proc/mounts: {}'.format(
+                mountpoint, ','.join(unverified)))
+        if len(unverified) < len(missing):
+            log('Mount options of {} are not active: {}'.format(
+                mountpoint, ','.join(set(missing) - set(unverified))))
+            return False
+    return True
+
+
+HASH_CHUNK_SIZE = 64 * 1024
+HASH_CACHE_FILE = '.file-hashes'
+HASH_CACHE_MIN_AGE = 2  # Files modified this recently (seconds) aren't cached.
+
+
+class FileHashCache(object):
+    """
+    Persisted map of path to digest, keyed on the (inode, size, mtime_ns) of
+    the file when it was hashed, so that unchanged files are recognised from a
+    `stat` instead of being read again.
+
+    Files modified within `HASH_CACHE_MIN_AGE` seconds are not cached, since
+    they could still be changed again without their mtime moving.  The cache
+    is stored in the charm directory, and saved at the end of the hook.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._data = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._data is None:
+            if self.path is None and charm_dir():
+                self.path = os.path.join(charm_dir(), HASH_CACHE_FILE)
+            self._data = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path) as fp:
+                        self._data = json.load(fp)
+                except ValueError:
+                    log('Discarding corrupt file hash cache {}'.format(self.path))
+            if self.path:
+                atexit(self.save)
+
+    def _key(self, st, hash_type):
+        return [st.st_ino, st.st_size, int(st.st_mtime * 1e9), hash_type]
+
+    def get(self, path, st, hash_type):
+        with self._lock:
+            self._load()
+            entry = self._data.get(path)
+            if entry and entry[:-1] == self._key(st, hash_type):
+                return entry[-1]
+            return None
+
+    def set(self, path, st, hash_type, digest):
+        if time.time() - st.st_mtime < HASH_CACHE_MIN_AGE:
+            return
+        with self._lock:
+            self._load()
+            self._data[path] = self._key(st, hash_type) + [digest]
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self.path:
+                return
+            write_file_atomic(self.path, json.dumps(self._data))
+            self._dirty = False
+
+
+file_hashes = FileHashCache()
+
+
+def file_hash(path, hash_type='md5'):
+    """Generate a hash of the contents of 'path' or None if not found
+
+    The file is read in chunks of `HASH_CHUNK_SIZE`, with any algorithm that
+    `hashlib.new` accepts.  Digests are kept in `file_hashes`, so a file
+    that hasn't changed since it was last hashed isn't read again.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
         return None
+    key = os.path.abspath(path)
+    digest = file_hashes.get(key, st, hash_type)
+    if digest is None:
+        h = hashlib.new(hash_type)
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), ''):
+                h.update(chunk)  # IGNORE:E1101 - it does have update
+        digest = h.hexdigest()
+        file_hashes.set(key, st, hash_type, digest)
+    return digest
+
+
+def path_hash(path, hash_type='md5'):
+    """Generate a hash of 'path' or None if not found
+
+    For a directory, this covers the names and contents of every file below
+    it, in sorted order; for a file, it is the same as `file_hash`.
+    """
+    if not os.path.isdir(path):
+        return file_hash(path, hash_type)
+    h = hashlib.new(hash_type)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            h.update('{}\0{}\0'.format(os.path.relpath(filename, path),
+                                         file_hash(filename, hash_type)))
+    return h.hexdigest()
+
+
+class RestartQueue(object):
+    """
+    Hook-scoped queue of service restarts.
+
+    Producers `enqueue` a service with a description of what triggered the
+    restart; requests for a service that is already queued are merged into
+    its existing entry, so each service is restarted at most once per hook,
+    no matter how many things asked for it.  The queue is run at the end of
+    the hook, or earlier for particular services with `run`, and logs the
+    triggers that were merged into each restart.
+
+    Entries are run in the order they were first queued.  Services queued
+    with `stopstart` are all stopped before any queued service is started or
+    restarted, as `restart_on_change` has always done.
+
+    A producer can supply its own `restart` callable, taking no arguments,
+    for services that aren't managed by the init system.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._scheduled = False
+
+    def enqueue(self, service_name, trigger, stopstart=False, restart=None):
+        with self._lock:
+            entry = self._entries.setdefault(service_name, {
+                'triggers': [], 'stopstart': False, 'restart': None})
+            if trigger not in entry['triggers']:
+                entry['triggers'].append(trigger)
+            entry['stopstart'] = entry['stopstart'] or stopstart
+            if restart is not None:
+                entry['restart'] = restart
+            if not self._scheduled:
+                atexit(self.run)
+                self._scheduled = True
+
+    def cancel(self, service_name):
+        """Drop any queued restart of `service_name`"""
+        with self._lock:
+            self._entries.pop(service_name, None)
+
+    def pending(self):
+        with self._lock:
+            return self._entries.keys()
+
+    def run(self, *service_names):
+        """Run the queued restarts of `service_names`, or of every service"""
+        with self._lock:
+            names = [name for name in self._entries
+                     if not service_names or name in service_names]
+            entries = [(name, self._entries.pop(name)) for name in names]
+            if not self._entries:
+                self._scheduled = False
+        for name, entry in entries:
+            if entry['stopstart'] and entry['restart'] is None:
+                service('stop', name)
+        for name, entry in entries:
+            log('Restarting {} once for: {}'.format(
+                name, '; '.join(entry['triggers'])))
+            if entry['restart'] is not None:
+                entry['restart']()
+            elif entry['stopstart']:
+                service('start', name)
+            else:
+                service('restart', name)
+
+
+restart_queue = RestartQueue()
 
 
 def restart_on_change(restart_map, stopstart=False):
@@ -249,25 +686,26 @@ def restart_on_change(restart_map, stopstart=False):
     In this example, the cinder-api and cinder-volume services
     would be restarted if /etc/ceph/ceph.conf is changed by the
     ceph_client_changed function.
+
+    A path may also be a directory, in which case the services are
+    restarted if any file below it is added, removed or changed.
+
+    The restarts are queued on `restart_queue`, and so happen once, at the
+    end of the hook, however many changes asked for them.
     """
     def wrap(f):
         def wrapped_f(*args):
             checksums = {}
             for path in restart_map:
-                checksums[path] = file_hash(path)
+                checksums[path] = path_hash(path)
             f(*args)
-            restarts = []
             for path in restart_map:
-                if checksums[path] != file_hash(path):
-                    restarts += restart_map[path]
-            services_list = list(OrderedDict.fromkeys(restarts))
-            if not stopstart:
-                for service_name in services_list:
-                    service('restart', service_name)
-            else:
-                for action in ['stop', 'start']:
-                    for service_name in services_list:
-                        service(action, service_name)
+                if checksums[path] != path_hash(path):
+                    for service_name in restart_map[path]:
+                        restart_queue.enqueue(
+                            service_name,
+                            '{} changed {}'.format(f.__name__, path),
+                            stopstart=stopstart)
         return wrapped_f
     return wrap
 
@@ -345,7 +783,17 @@ def cmp_pkgrevno(package, revno, pkgcache=None):
     *  0 => Installed revno is the same as supplied arg
     * -1 => Installed revno is less than supplied arg
 
+    The installed version is looked up in the dpkg status file, and apt's
+    cache is only built if dpkg doesn't know the package (or `pkgcache` is
+    given).
     '''
+    if not pkgcache:
+        try:
+            installed = dpkg.installed_version(package)
+        except (IOError, OSError, subprocess.CalledProcessError):
+            installed = None
+        if installed is not None:
+            return dpkg.version_compare(installed, revno)
     import apt_pkg
     if not pkgcache:
         apt_pkg.init()
@@ -363,13 +811,80 @@ def chdir(d):
         os.chdir(cur)
 
 
-def chownr(path, owner, group):
+def _chown_entries(directory, uid, gid, subdirs):
+    """
+    Fix the ownership of the entries of `directory`, appending its real
+    subdirectories to `subdirs`.  Returns the (visited, changed, skipped)
+    counts.
+    """
+    visited = changed = skipped = 0
+    if scandir is not None:
+        entries = ((entry.path, entry.stat(follow_symlinks=False))
+                   for entry in scandir(directory))
+    else:
+        entries = ((os.path.join(directory, name),
+                    os.lstat(os.path.join(directory, name)))
+                   for name in os.listdir(directory))
+    for full, lstat in entries:
+        visited += 1
+        status = lstat
+        if stat.S_ISLNK(lstat.st_mode):
+            # chown follows symlinks, so it's the target's owner that counts;
+            # broken symlinks are left alone.
+            try:
+                status = os.stat(full)
+            except OSError:
+                skipped += 1
+                continue
+        if (status.st_uid, status.st_gid) == (uid, gid):
+            skipped += 1
+        else:
+            os.chown(full, uid, gid)
+            changed += 1
+        if stat.S_ISDIR(lstat.st_mode):
+            subdirs.append(full)
+    return visited, changed, skipped
+
+
+def _chown_tree(path, uid, gid):
+    counts = [0, 0, 0]
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        for i, count in enumerate(_chown_entries(directory, uid, gid, pending)):
+            counts[i] += count
+    return counts
+
+
+def chownr(path, owner, group, workers=CHOWN_WORKERS):
+    """
+    Recursively change the ownership of everything below `path`, but not of
+    `path` itself.  Symlinks are followed, except broken ones, but not
+    descended into.
+
+    Entries that already have the right owner and group are not touched.
+    The tree is split into subtrees that are walked by up to `workers`
+    threads.  Returns a dict counting the entries `visited`, `changed` and
+    `skipped`.
+    """
     uid = pwd.getpwnam(owner).pw_uid
     gid = grp.getgrnam(group).gr_gid
 
-    for root, dirs, files in os.walk(path):
-        for name in dirs + files:
-            full = os.path.join(root, name)
-            broken_symlink = os.path.lexists(full) and not os.path.exists(full)
-            if not broken_symlink:
-                os.chown(full, uid, gid)
+    counts = [0, 0, 0]
+    frontier = [path]
+    while frontier and len(frontier) < max(workers, 1) * 4:
+        subdirs = []
+        for directory in frontier:
+            for i, count in enumerate(_chown_entries(directory, uid, gid, subdirs)):
+                counts[i] += count
+        frontier = subdirs
+    if frontier:
+        for tree_counts in map_concurrently(
+                lambda directory: _chown_tree(directory, uid, gid),
+                frontier, workers):
+            for i, count in enumerate(tree_counts):
+                counts[i] += count
+    stats = dict(zip(('visited', 'changed', 'skipped'), counts))
+    log('chownr {} {}:{}: {visited} visited, {changed} changed, '
+        '{skipped} skipped'.format(path, owner, group, **stats))
+    return stats
@@ -1,19 +1,172 @@
 import os
 import re
+import sys
+import copy
 import json
-from collections import Iterable
+import Queue
+import hashlib
+import threading
+from collections import Iterable, Mapping
 
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
 
 
-__all__ = ['ServiceManager', 'ManagerCallback',
+__all__ = ['ServiceManager', 'ManagerCallback', 'ServiceNotReady',
+           'ServiceManagerError', 'ManagerState', 'data_fingerprint',
            'PortManagerCallback', 'open_ports', 'close_ports', 'manage_ports',
+           'ChangeOnlyCallback', 'on_change',
            'service_restart', 'service_stop']
 
+SERVICE_WORKERS = 4  # Maximum number of services handled at once.
+
+# State that mirrors hook tool calls (open-port, close-port, relation-set),
+# which Juju discards when the hook fails.
+HOOK_TOOL_STATE = ('ports', 'withheld')
+
+
+def data_fingerprint(item):
+    """
+    Return a stable fingerprint of a 'required_data' item.
+
+    Items that have a `fingerprint()` method provide the data to fingerprint
+    themselves; mappings are fingerprinted by their items, and anything else
+    by its attributes.
+    """
+    if hasattr(item, 'fingerprint'):
+        data = item.fingerprint()
+    elif isinstance(item, Mapping):
+        data = dict(item.items())
+    else:
+        data = vars(item)
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=repr)).hexdigest()
+
+
+class ServiceNotReady(Exception):
+    """
+    Raised by a 'start' callback when a service was started but is not yet
+    able to serve.  The remaining 'start' callbacks are skipped and the
+    service's 'provided_data' is withheld until a later hook finds it ready.
+    Once every service has been handled, the error is re-raised to fail the
+    hook, so that Juju retries it.
+    """
+    pass
+
+
+class ServiceManagerError(Exception):
+    """
+    Raised once all services have been handled if more than one of them
+    failed.  `errors` maps each failed service name to its exception.
+    """
+    def __init__(self, errors):
+        super(ServiceManagerError, self).__init__('Services failed: {}'.format(
+            ', '.join('{} ({})'.format(name, error)
+                      for name, error in sorted(errors.items()))))
+        self.errors = errors
+
+
+class ManagerState(object):
+    """
+    The state a `ServiceManager` and its callbacks keep between hooks, such
+    as readiness, applied ports and container ids, held per service in a
+    single JSON file in the charm directory.
+
+    The file is read once, on first use.  Changes are made in memory and
+    written back by `commit`, only if anything changed, to a temporary file
+    that is synced and then renamed over the original.
+    `ServiceManager.manage` commits at the end of every hook, first using
+    `revert` to drop changes that a failed hook did not really make.
+    """
+    STATE_FILE_NAME = '.manager-state'
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(hookenv.charm_dir(),
+                                         ManagerState.STATE_FILE_NAME)
+        self.is_new = not os.path.exists(self.path)
+        self._data = None
+        self._committed = None
+        self._dirty = False
+        self._obsolete = []
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._data is None:
+            if os.path.exists(self.path):
+                with open(self.path) as fp:
+                    self._data = json.load(fp)
+            else:
+                self._data = {}
+            self._committed = copy.deepcopy(self._data)
+
+    def get(self, service_name, key, default=None):
+        """
+        Return a copy of the value stored under `key` for a service.
+        """
+        with self._lock:
+            self._load()
+            return copy.deepcopy(self._data.get(service_name, {}).get(key, default))
+
+    def set(self, service_name, key, value):
+        """
+        Store `value` under `key` for a service.
+        """
+        with self._lock:
+            self._load()
+            service = self._data.setdefault(service_name, {})
+            if key not in service or service[key] != value:
+                service[key] = copy.deepcopy(value)
+                self._dirty = True
+
+    def delete(self, service_name, key):
+        with self._lock:
+            self._load()
+            service = self._data.get(service_name, {})
+            if key in service:
+                del service[key]
+                self._dirty = True
+
+    def revert(self, key):
+        """
+        Restore the value stored under `key` for every service to what was
+        last committed.
+        """
+        with self._lock:
+            self._load()
+            for service_name in set(self._data) | set(self._committed):
+                committed = self._committed.get(service_name, {})
+                if key in committed:
+                    self.set(service_name, key, committed[key])
+                else:
+                    self.delete(service_name, key)
+
+    def replaces(self, path):
+        """
+        Note that the state from the file at `path` has been taken over, so
+        that the file is removed once the state has been committed.
+        """
+        with self._lock:
+            self._obsolete.append(path)
+            self._dirty = True
+
+    def commit(self):
+        """
+        Write the state to disk, if it changed.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._load()
+            host.write_file_atomic(self.path, json.dumps(self._data))
+            self._committed = copy.deepcopy(self._data)
+            self._dirty = False
+            for path in self._obsolete:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._obsolete = []
+
 
 class ServiceManager(object):
-    def __init__(self, services=None):
+    def __init__(self, services=None, workers=SERVICE_WORKERS):
         """
         Register a list of services, given their definitions.
 
@@ -36,6 +189,7 @@ class ServiceManager(object):
                 "start": <one or more callbacks>,
                 "stop": <one or more callbacks>,
                 "ports": <list of ports to manage>,
+                "dependencies": <list of service names>,
             }
 
         The 'required_data' list should contain dicts of required data (or
@@ -72,7 +226,28 @@ class ServiceManager(object):
         The 'ports' value should be a list of ports to manage.  The default
         'start' handler will open the ports after the service is started,
         and the default 'stop' handler will close the ports prior to stopping
-        the service.
+        the service.  Each port may be a number, a 'port/protocol' string such
+        as '53/udp', or a range such as '8000-8100/tcp' (which needs a version
+        of Juju that supports port ranges).
+
+        The 'dependencies' value should be a list of the names of other
+        registered services that must be handled first.  Services are started
+        once all of their dependencies have been, and stopped once all of the
+        services depending on them have been.  Services that do not depend on
+        one another are handled concurrently, by up to `workers` threads.  If
+        a service fails, the services depending on it are skipped, while the
+        others carry on; the failure is raised once all are done.
+
+        Each time a service is found ready, a fingerprint of every 'required_data'
+        item is compared with the one recorded the last time the service was
+        started.  Callbacks with a true `only_on_change` attribute (see
+        `services.on_change`) are skipped for 'data_ready' and 'start' when
+        nothing changed; `changed_data()` tells callbacks which items did.
+
+        If a 'start' callback raises `ServiceNotReady` (see
+        `services.wait_for_ready`), the rest of the 'start' callbacks are
+        skipped and the service's 'provided_data' is not published until a
+        later hook finds the service ready.
 
 
         Examples:
@@ -104,8 +279,13 @@ class ServiceManager(object):
             ])
             manager.manage()
         """
-        self._ready_file = os.path.join(hookenv.charm_dir(), '.ready')
-        self._ready = None
+        self._state = None
+        self._not_serving = {}
+        self._changed = {}
+        self._fingerprints = {}
+        self._changed_files = {}
+        self._lock = threading.RLock()
+        self.workers = workers
         self.services = {}
         for service in services or []:
             service_name = service['service']
@@ -114,22 +294,127 @@ class ServiceManager(object):
     def manage(self):
         """
         Handle the current hook by doing The Right Thing with the registered services.
+
+        The manager state is committed once the hook is done.  If it failed,
+        the ports and withheld data recorded during it are dropped first,
+        since Juju discards the hook tool calls that applied them.
         """
         hook_name = hookenv.hook_name()
-        if hook_name == 'stop':
-            self.stop_services()
-        else:
-            self.provide_data()
-            self.reconfigure_services()
+        try:
+            try:
+                if hook_name == 'stop':
+                    self.stop_services()
+                else:
+                    self.reconfigure_services()
+                    self.provide_data()
+                    self._raise_not_serving()
+            finally:
+                hookenv._run_atexit()
+        except Exception:
+            exc_info = sys.exc_info()
+            if self._state is not None:
+                for key in HOOK_TOOL_STATE:
+                    self._state.revert(key)
+                self._state.commit()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self._state is not None:
+            self._state.commit()
+
+    def _raise_not_serving(self):
+        """
+        Fail the hook if any service raised `ServiceNotReady`, once the
+        others have been handled and their data provided, so that Juju
+        retries it; nothing else would bring the service back into service.
+        """
+        if len(self._not_serving) == 1:
+            exc_info = self._not_serving.values()[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self._not_serving:
+            raise ServiceManagerError(dict(
+                (name, exc_info[1])
+                for name, exc_info in self._not_serving.items()))
+
+    @property
+    def state(self):
+        """
+        The `ManagerState` for the registered services, which `manage`
+        commits at the end of the hook.
+        """
+        with self._lock:
+            if self._state is None:
+                self._state = ManagerState()
+                if self._state.is_new:
+                    self._migrate_legacy_state()
+                    self._state.commit()
+            return self._state
+
+    def _migrate_legacy_state(self):
+        """
+        Take over the state kept in separate files by earlier versions.
+
+        Earlier versions wrote a service's ports file when stopping it,
+        before closing its ports, so the ports are only taken over for
+        services that were ready.
+        """
+        charm_dir = hookenv.charm_dir()
+        ready_file = os.path.join(charm_dir, '.ready')
+        ready = set()
+        if os.path.exists(ready_file):
+            with open(ready_file) as fp:
+                ready.update(json.load(fp))
+            for service_name in ready:
+                self._state.set(service_name, 'ready', True)
+            self._state.replaces(ready_file)
+        withheld_file = os.path.join(charm_dir, '.withheld')
+        if os.path.exists(withheld_file):
+            with open(withheld_file) as fp:
+                withheld = set(json.load(fp))
+            for service_name, service in self.services.items():
+                names = [provider.name for provider in service.get('provided_data', [])
+                         if provider.name in withheld]
+                self._state.set(service_name, 'withheld', names)
+            self._state.replaces(withheld_file)
+        for service_name in self.services:
+            port_file = os.path.join(charm_dir, '.{}.ports'.format(service_name))
+            if os.path.exists(port_file):
+                if service_name in ready:
+                    with open(port_file) as fp:
+                        ports = [int(port) for port in fp.read().split(',') if port]
+                    self._state.set(service_name, 'ports', ports)
+                self._state.replaces(port_file)
 
     def provide_data(self):
+        """
+        Publish the 'provided_data' of each service on its relations.
+
+        Data is set when handling the provider's own relation hooks.  It is
+        withheld while the service is not serving (see `ServiceNotReady`), and
+        then published on every relation of the provider once it is.
+        """
         hook_name = hookenv.hook_name()
-        for service in self.services.values():
-            for provider in service.get('provided_data', []):
+        for service_name, service in self.services.items():
+            providers = service.get('provided_data', [])
+            if not providers:
+                continue
+            withheld = set(self.state.get(service_name, 'withheld', []))
+            for provider in providers:
+                if service_name in self._not_serving:
+                    hookenv.log('Withholding {} data until {} is ready'.format(
+                        provider.name, service_name))
+                    withheld.add(provider.name)
+                    continue
                 if re.match(r'{}-relation-(joined|changed)'.format(provider.name), hook_name):
-                    data = provider.provide_data()
-                    if provider._is_ready(data):
-                        hookenv.relation_set(None, data)
+                    relation_ids = [None]
+                elif provider.name in withheld:
+                    relation_ids = hookenv.relation_ids(provider.name)
+                else:
+                    continue
+                data = provider.provide_data()
+                if provider._is_ready(data):
+                    for relation_id in relation_ids:
+                        hookenv.relation_set(relation_id, data)
+                    withheld.discard(provider.name)
+            self.state.set(service_name, 'withheld', sorted(withheld))
 
     def reconfigure_services(self, *service_names):
         """
@@ -138,20 +423,68 @@ class ServiceManager(object):
 
         If no service names are given, reconfigures all registered services.
         """
-        for service_name in service_names or self.services.keys():
-            if self.is_ready(service_name):
-                self.fire_event('data_ready', service_name)
+        self._run_services(service_names or self.services.keys(),
+                           self._reconfigure_service)
+
+    def _reconfigure_service(self, service_name):
+        if self.is_ready(service_name):
+            self.changed_data(service_name)
+            self.fire_event('data_ready', service_name)
+            try:
                 self.fire_event('start', service_name, default=[
                     service_restart,
                     manage_ports])
-                self.save_ready(service_name)
+            except ServiceNotReady as e:
+                hookenv.log(str(e), hookenv.WARNING)
+                self._not_serving[service_name] = sys.exc_info()
             else:
-                if self.was_ready(service_name):
-                    self.fire_event('data_lost', service_name)
-                self.fire_event('stop', service_name, default=[
-                    manage_ports,
-                    service_stop])
-                self.save_lost(service_name)
+                self.state.set(service_name, 'data_fingerprints',
+                               self._fingerprints[service_name])
+            self.save_ready(service_name)
+        else:
+            if self.was_ready(service_name):
+                self.fire_event('data_lost', service_name)
+            self.fire_event('stop', service_name, default=[
+                manage_ports,
+                service_stop])
+            self.state.delete(service_name, 'data_fingerprints')
+            self.save_lost(service_name)
+
+    def changed_data(self, service_name):
+        """
+        Return the 'required_data' items of a service that changed since it
+        was last started.
+        """
+        if service_name not in self._changed:
+            previous = self.state.get(service_name, 'data_fingerprints', {})
+            fingerprints = {}
+            changed = []
+            service = self.get_service(service_name)
+            for index, item in enumerate(service.get('required_data', [])):
+                key = '{}:{}'.format(index, item.__class__.__name__)
+                fingerprints[key] = data_fingerprint(item)
+                if previous.get(key) != fingerprints[key]:
+                    changed.append(item)
+            self._fingerprints[service_name] = fingerprints
+            self._changed[service_name] = changed
+        return self._changed[service_name]
+
+    def mark_changed(self, service_name, path):
+        """
+        Record that a callback rewrote `path` on behalf of a service during
+        this hook.
+        """
+        with self._lock:
+            self._changed_files.setdefault(service_name, []).append(path)
+
+    def changed_files(self, service_name):
+        """
+        Return the paths recorded with `mark_changed` for a service during
+        this hook, so later callbacks can tell whether anything on disk
+        actually changed.
+        """
+        with self._lock:
+            return list(self._changed_files.get(service_name, []))
 
     def stop_services(self, *service_names):
         """
@@ -159,10 +492,92 @@ class ServiceManager(object):
 
         If no service names are given, stops all registered services.
         """
-        for service_name in service_names or self.services.keys():
-            self.fire_event('stop', service_name, default=[
-                manage_ports,
-                service_stop])
+        self._run_services(service_names or self.services.keys(),
+                           self._stop_service, reverse=True)
+
+    def _stop_service(self, service_name):
+        self.fire_event('stop', service_name, default=[
+            manage_ports,
+            service_stop])
+
+    def _run_services(self, service_names, action, reverse=False):
+        """
+        Call `action` for each of the given services, in the order given by
+        their 'dependencies' (or the reverse of it), running services that do
+        not depend on each other concurrently.
+
+        Services whose dependencies failed are skipped.  Once every service
+        has been handled, a single failure is re-raised as is, and several are
+        raised together as a `ServiceManagerError`.
+        """
+        service_names = set(service_names)
+        graph = dict((name, set()) for name in service_names)
+        for name in service_names:
+            for dependency in self.get_service(name).get('dependencies', []):
+                self.get_service(dependency)
+                if dependency not in service_names:
+                    continue
+                if reverse:
+                    graph[dependency].add(name)
+                else:
+                    graph[name].add(dependency)
+
+        outcome = {}
+        errors = {}
+        done = Queue.Queue()
+        running = 0
+        inline = len(service_names) == 1 or self.workers <= 1
+
+        def run(name):
+            try:
+                action(name)
+            except Exception:
+                done.put((name, sys.exc_info()))
+            else:
+                done.put((name, None))
+
+        while graph or running:
+            progress = True
+            while progress and running < self.workers:
+                progress = False
+                for name in sorted(graph):
+                    waits_on = graph[name]
+                    if not waits_on.issubset(outcome):
+                        continue
+                    del graph[name]
+                    progress = True
+                    failed = sorted(dep for dep in waits_on if not outcome[dep])
+                    if failed:
+                        hookenv.log('Skipping {}: {} failed'.format(
+                            name, ', '.join(failed)), hookenv.WARNING)
+                        outcome[name] = False
+                        continue
+                    running += 1
+                    if inline:
+                        run(name)
+                    else:
+                        thread = threading.Thread(target=run, args=(name,))
+                        thread.daemon = True
+                        thread.start()
+                    break
+            if running == 0:
+                if graph:
+                    raise ValueError('Circular service dependencies: {}'.format(
+                        ', '.join(sorted(graph))))
+                break
+            name, exc_info = done.get()
+            running -= 1
+            outcome[name] = exc_info is None
+            if exc_info is not None:
+                errors[name] = exc_info
+                hookenv.log('Error handling {}: {}'.format(name, exc_info[1]),
+                            hookenv.ERROR)
+        if len(errors) == 1:
+            exc_info = errors.values()[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if errors:
+            raise ServiceManagerError(dict(
+                (name, exc_info[1]) for name, exc_info in errors.items()))
 
     def get_service(self, service_name):
         """
@@ -184,6 +599,10 @@ class ServiceManager(object):
         if not isinstance(callbacks, Iterable):
             callbacks = [callbacks]
         for callback in callbacks:
+            if getattr(callback, 'only_on_change', False) and \
+                    event_name in ('data_ready', 'start') and \
+                    not self.changed_data(service_name):
+                continue
             if isinstance(callback, ManagerCallback):
                 callback(self, service_name, event_name)
             else:
@@ -200,43 +619,23 @@ class ServiceManager(object):
         reqs = service.get('required_data', [])
         return all(bool(req) for req in reqs)
 
-    def _load_ready_file(self):
-        if self._ready is not None:
-            return
-        if os.path.exists(self._ready_file):
-            with open(self._ready_file) as fp:
-                self._ready = set(json.load(fp))
-        else:
-            self._ready = set()
-
-    def _save_ready_file(self):
-        if self._ready is None:
-            return
-        with open(self._ready_file, 'w') as fp:
-            json.dump(list(self._ready), fp)
-
     def save_ready(self, service_name):
         """
         Save an indicator that the given service is now data_ready.
         """
-        self._load_ready_file()
-        self._ready.add(service_name)
-        self._save_ready_file()
+        self.state.set(service_name, 'ready', True)
 
     def save_lost(self, service_name):
         """
         Save an indicator that the given service is no longer data_ready.
         """
-        self._load_ready_file()
-        self._ready.discard(service_name)
-        self._save_ready_file()
+        self.state.set(service_name, 'ready', False)
 
     def was_ready(self, service_name):
         """
         Determine if the given service was previously data_ready.
         """
-        self._load_ready_file()
-        return service_name in self._ready
+        return self.state.get(service_name, 'ready', False)
 
 
 class ManagerCallback(object):
@@ -250,42 +649,82 @@ class ManagerCallback(object):
         * `service_name`  The name of the service it's being triggered for
         * `event_name`    The name of the event that this callback is handling
     """
+    only_on_change = False
+
     def __call__(self, manager, service_name, event_name):
         raise NotImplementedError()
 
 
+class ChangeOnlyCallback(ManagerCallback):
+    """
+    Wraps a callback so that, as a 'data_ready' or 'start' action, it only
+    fires when some of the service's 'required_data' changed since the
+    service was last started.
+    """
+    only_on_change = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __call__(self, manager, service_name, event_name):
+        if isinstance(self.callback, ManagerCallback):
+            self.callback(manager, service_name, event_name)
+        else:
+            self.callback(service_name)
+
+
 class PortManagerCallback(ManagerCallback):
     """
     Callback class that will open or close ports, for use as either
     a start or stop action.
+
+    The ports opened for each service are recorded, and only the difference
+    between them and the ports wanted is applied, with the `open-port` and
+    `close-port` calls made concurrently.
     """
     def __call__(self, manager, service_name, event_name):
         service = manager.get_service(service_name)
-        new_ports = service.get('ports', [])
-        port_file = os.path.join(hookenv.charm_dir(), '.{}.ports'.format(service_name))
-        if os.path.exists(port_file):
-            with open(port_file) as fp:
-                old_ports = fp.read().split(',')
-            for old_port in old_ports:
-                if bool(old_port):
-                    old_port = int(old_port)
-                    if old_port not in new_ports:
-                        hookenv.close_port(old_port)
-        with open(port_file, 'w') as fp:
-            fp.write(','.join(str(port) for port in new_ports))
-        for port in new_ports:
-            if event_name == 'start':
-                hookenv.open_port(port)
-            elif event_name == 'stop':
-                hookenv.close_port(port)
+        applied = set(self.parse_port(port) for port in
+                      manager.state.get(service_name, 'ports', []))
+        if event_name == 'start':
+            wanted = set(self.parse_port(port) for port in service.get('ports', []))
+        else:
+            wanted = set()
+        to_close = sorted(applied - wanted)
+        to_open = sorted(wanted - applied)
+        hookenv.map_concurrently(lambda port: hookenv.close_port(*port), to_close)
+        manager.state.set(service_name, 'ports',
+                          ['{}/{}'.format(*port) for port in sorted(applied & wanted)])
+        hookenv.map_concurrently(lambda port: hookenv.open_port(*port), to_open)
+        manager.state.set(service_name, 'ports',
+                          ['{}/{}'.format(*port) for port in sorted(wanted)])
+
+    @staticmethod
+    def parse_port(port):
+        """
+        Return `(port, protocol)` for a 'ports' entry, where `port` is a string
+        holding a single port or a range, and `protocol` is 'TCP' or 'UDP'.
+        """
+        protocol = 'TCP'
+        if isinstance(port, (tuple, list)):
+            port, protocol = port
+        else:
+            port = str(port)
+            if '/' in port:
+                port, protocol = port.split('/', 1)
+        return str(port), protocol.upper()
 
 
 def service_stop(service_name):
     """
     Wrapper around host.service_stop to prevent spurious "unknown service"
     messages in the logs.
+
+    Any restart of the service still queued on `host.restart_queue` is
+    dropped.
     """
-    if host.service_running(service_name):
+    host.restart_queue.cancel(service_name)
+    if host.service_status.running(service_name):
         host.service_stop(service_name)
 
 
@@ -293,13 +732,24 @@ def service_restart(service_name):
     """
     Wrapper around host.service_restart to prevent spurious "unknown service"
     messages in the logs.
+
+    The restart is queued on `host.restart_queue`, so it is merged with any
+    other restart of the service requested during the hook and run once, at
+    the end of it.
+
+    The service is checked through `host.service_status`, which asks the
+    init system about all services once per hook.
     """
-    if host.service_available(service_name):
-        if host.service_running(service_name):
-            host.service_restart(service_name)
-        else:
-            host.service_start(service_name)
+    def restart():
+        if host.service_status.available(service_name):
+            if host.service_status.running(service_name):
+                host.service_restart(service_name)
+            else:
+                host.service_start(service_name)
+    host.restart_queue.enqueue(service_name, 'service_restart',
+                               restart=restart)
 
 
 # Convenience aliases
 open_ports = close_ports = manage_ports = PortManagerCallback()
+on_change = ChangeOnlyCallback
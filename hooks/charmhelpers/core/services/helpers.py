@@ -1,11 +1,19 @@
+import os
+import time
+import socket
+import httplib
+
+from charmhelpers.core import host
 from charmhelpers.core import hookenv
 from charmhelpers.core import templating
 
-from charmhelpers.core.services.base import ManagerCallback
+from charmhelpers.core.services.base import (
+    ManagerCallback, ServiceNotReady, data_fingerprint)
 
 
 __all__ = ['RelationContext', 'TemplateCallback',
-           'render_template', 'template']
+           'render_template', 'template',
+           'ReadinessCallback', 'wait_for_ready', 'tcp_probe', 'http_probe']
 
 
 class RelationContext(dict):
@@ -19,14 +27,38 @@ class RelationContext(dict):
 
     The generated context will be namespaced under the interface type, to prevent
     potential naming conflicts.
+
+    Subclasses that set `persistent` to True read their data from
+    `hookenv.relation_snapshot()`, which only queries Juju for the unit that
+    triggered the hook, instead of querying every related unit.
+
+    The data is not retrieved until the context is first consulted, so hooks
+    which never look at it don't query Juju at all.  Note that `dict(context)`
+    and `dict.update(context)` read the underlying dict directly; use
+    `context.items()` to copy a context that may not have been consulted yet.
     """
     name = None
     interface = None
     required_keys = []
+    persistent = False
 
     def __init__(self, *args, **kwargs):
         super(RelationContext, self).__init__(*args, **kwargs)
-        self.get_data()
+        self._units = []
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            self.get_data()
+
+    @property
+    def units(self):
+        """
+        The names of the units whose data is in `self[self.name]`, in order.
+        """
+        self._load()
+        return self._units
 
     def __bool__(self):
         """
@@ -37,8 +69,65 @@ class RelationContext(dict):
     __nonzero__ = __bool__
 
     def __repr__(self):
+        self._load()
         return super(RelationContext, self).__repr__()
 
+    def __getitem__(self, key):
+        self._load()
+        return super(RelationContext, self).__getitem__(key)
+
+    def __contains__(self, key):
+        self._load()
+        return super(RelationContext, self).__contains__(key)
+
+    def __iter__(self):
+        self._load()
+        return super(RelationContext, self).__iter__()
+
+    def __len__(self):
+        self._load()
+        return super(RelationContext, self).__len__()
+
+    def __eq__(self, other):
+        self._load()
+        return super(RelationContext, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get(self, key, default=None):
+        self._load()
+        return super(RelationContext, self).get(key, default)
+
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        self._load()
+        return super(RelationContext, self).keys()
+
+    def values(self):
+        self._load()
+        return super(RelationContext, self).values()
+
+    def items(self):
+        self._load()
+        return super(RelationContext, self).items()
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        self._load()
+        return super(RelationContext, self).itervalues()
+
+    def iteritems(self):
+        self._load()
+        return super(RelationContext, self).iteritems()
+
+    def copy(self):
+        return dict(self.items())
+
     def is_ready(self):
         """
         Returns True if all of the `required_keys` are available from any units.
@@ -59,7 +148,7 @@ class RelationContext(dict):
         """
         Retrieve the relation data for each unit involved in a realtion and,
         if complete, store it in a list under `self[self.name]`.  This
-        is automatically called when the RelationContext is instantiated.
+        is automatically called when the RelationContext is first consulted.
 
         The units are sorted lexographically first by the service ID, then by
         the unit ID.  Thus, if an interface has two other services, 'db:1'
@@ -80,17 +169,26 @@ class RelationContext(dict):
         Note that since all sets of relation data from all related services and
         units are in a single list, if you need to know which service or unit a
         set of data came from, you'll need to extend this class to preserve
-        that information.
+        that information.  The unit names alone are kept, in the same order as
+        the data, in `self.units`.
+
+        The hook tool calls are issued concurrently by `hookenv.relation_data`;
+        the ordering described above is applied once all of the data is in.
         """
-        if not hookenv.relation_ids(self.name):
+        if self.persistent:
+            rels = hookenv.relation_snapshot().units(self.name)
+        else:
+            rels = hookenv.relation_data(self.name)[self.name]
+        if not rels:
             return
 
         ns = self.setdefault(self.name, [])
-        for rid in sorted(hookenv.relation_ids(self.name)):
-            for unit in sorted(hookenv.related_units(rid)):
-                reldata = hookenv.relation_get(rid=rid, unit=unit)
+        for rid in sorted(rels):
+            for unit in sorted(rels[rid]):
+                reldata = rels[rid][unit]
                 if self._is_ready(reldata):
                     ns.append(reldata)
+                    self._units.append(unit)
 
     def provide_data(self):
         """
@@ -104,6 +202,15 @@ class TemplateCallback(ManagerCallback):
     Callback class that will render a template, for use as a ready action.
 
     The `target` param, if omitted, will default to `/etc/init/<service name>`.
+
+    The target is only rewritten if its rendered content changed, in which
+    case it is recorded with `manager.mark_changed`.  Returns True if the
+    target was rewritten.
+
+    The context keys the template reads are recorded in the manager state,
+    along with a fingerprint of their values, the template source and the
+    target's ownership and permissions.  If none of those changed and the
+    target still exists, the template is not rendered at all.
     """
     def __init__(self, source, target, owner='root', group='root', perms=0444):
         self.source = source
@@ -116,10 +223,130 @@ class TemplateCallback(ManagerCallback):
         service = manager.get_service(service_name)
         context = {}
         for ctx in service.get('required_data', []):
-            context.update(ctx)
-        templating.render(self.source, self.target, context,
-                          self.owner, self.group, self.perms)
+            context.update(ctx.items())
+        variables, source_hash = templating.template_dependencies(self.source)
+        keys = sorted(context if variables is None else variables)
+        fingerprint = data_fingerprint({
+            'source': source_hash,
+            'values': dict((key, context.get(key)) for key in keys),
+            'owner': self.owner,
+            'group': self.group,
+            'perms': self.perms,
+        })
+        templates = manager.state.get(service_name, 'templates', {})
+        previous = templates.get(self.target, {})
+        if previous.get('fingerprint') == fingerprint and os.path.exists(self.target):
+            hookenv.log('Skipping render of {}; none of {} changed'.format(
+                self.target, ', '.join(keys) or 'its inputs'), hookenv.DEBUG)
+            return False
+        changed = templating.render(self.source, self.target, context,
+                                    self.owner, self.group, self.perms)
+        if changed:
+            manager.mark_changed(service_name, self.target)
+        templates[self.target] = {'keys': keys, 'fingerprint': fingerprint}
+        manager.state.set(service_name, 'templates', templates)
+        return changed
 
 
 # Convenience aliases for templates
 render_template = template = TemplateCallback
+
+
+def tcp_probe(host, port, timeout=2):
+    """
+    Returns True if a TCP connection can be made to `host:port`.
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except socket.error:
+        return False
+    sock.close()
+    return True
+
+
+def http_probe(host, port, path='/', timeout=2):
+    """
+    Returns True if an HTTP GET of `path` on `host:port` gets a non-5xx reply.
+    """
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        return conn.getresponse().status < 500
+    except (socket.error, httplib.HTTPException):
+        return False
+    finally:
+        conn.close()
+
+
+class ReadinessCallback(ManagerCallback):
+    """
+    Callback class that waits for a started service to accept connections,
+    for use as a start action between the action that starts the service and
+    the one that opens its ports.
+
+    `probes` is a list of `(port, kind)` pairs, where `kind` is either `'tcp'`
+    or `'http'`.  All probes are run concurrently; each one is retried, with
+    its interval growing by `backoff` up to `max_interval`, until it passes or
+    `timeout` seconds have passed.  The time each probe took to pass is logged.
+
+    `host` is the address to probe, or a callable taking the manager and the
+    service name that returns it, such as `docker.container_address`, for
+    services whose address is only known once they have started.  Probe a
+    service directly, rather than through a proxy in front of it which may
+    accept connections before the service does.
+
+    If any probe fails, `ServiceNotReady` is raised, which stops the rest of
+    the start actions, withholds the service's 'provided_data', and fails the
+    hook once every service has been handled, so that Juju retries it.
+
+    A restart of the service still queued on `host.restart_queue` is run
+    before probing, rather than at the end of the hook.
+    """
+    def __init__(self, probes, host='127.0.0.1', timeout=60, interval=0.5,
+                 backoff=2, max_interval=5, probe_timeout=2):
+        self.probes = probes
+        self.host = host
+        self.timeout = timeout
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.probe_timeout = probe_timeout
+
+    def __call__(self, manager, service_name, event_name):
+        if event_name != 'start':
+            return
+        host.restart_queue.run(service_name)
+        address = self.host
+        if callable(address):
+            address = address(manager, service_name)
+        started = time.time()
+        latencies = hookenv.map_concurrently(
+            lambda probe: self._wait(address, probe, started + self.timeout,
+                                     started),
+            self.probes)
+        hookenv.log('Readiness of {} at {}: {}'.format(service_name, address, ', '.join(
+            '{}/{} {}'.format(port, kind, 'failed' if latency is None
+                              else '{:.2f}s'.format(latency))
+            for (port, kind), latency in zip(self.probes, latencies))))
+        failed = ['{}/{}'.format(port, kind)
+                  for (port, kind), latency in zip(self.probes, latencies)
+                  if latency is None]
+        if failed:
+            raise ServiceNotReady('{} is not ready after {}s: {} failed'.format(
+                service_name, self.timeout, ', '.join(failed)))
+
+    def _wait(self, address, probe, deadline, started):
+        port, kind = probe
+        check = http_probe if kind == 'http' else tcp_probe
+        interval = self.interval
+        while True:
+            if check(address, port, timeout=self.probe_timeout):
+                return time.time() - started
+            if time.time() + interval > deadline:
+                return None
+            time.sleep(interval)
+            interval = min(interval * self.backoff, self.max_interval)
+
+
+# Convenience aliases for readiness probes
+wait_for_ready = ReadinessCallback
@@ -1,9 +1,114 @@
 import os
+import pwd
+import grp
+import hashlib
 
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
 
 
+BYTECODE_CACHE_DIR = '.jinja-cache'
+
+_environments = {}
+
+
+def _jinja2():
+    try:
+        import jinja2
+    except ImportError:
+        try:
+            from charmhelpers.fetch import apt_install, apt_commit
+        except ImportError:
+            hookenv.log('Could not import jinja2, and could not import '
+                        'charmhelpers.fetch to install it',
+                        level=hookenv.ERROR)
+            raise
+        apt_install('python-jinja2', fatal=True)
+        apt_commit()
+        import jinja2
+    return jinja2
+
+
+def environment(templates_dir):
+    """
+    Return the jinja2 `Environment` for `templates_dir`.
+
+    Environments are created once per process, and compiled templates are
+    kept in a bytecode cache under the charm directory, so they are only
+    recompiled when their source changes.
+    """
+    env = _environments.get(templates_dir)
+    if env is None:
+        jinja2 = _jinja2()
+        bytecode_cache = None
+        if hookenv.charm_dir():
+            cache_dir = os.path.join(hookenv.charm_dir(), BYTECODE_CACHE_DIR)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir),
+                                 bytecode_cache=bytecode_cache)
+        _environments[templates_dir] = env
+    return env
+
+
+@hookenv.cached
+def template_dependencies(source, templates_dir=None):
+    """
+    Return `(variables, source_hash)` for a template.
+
+    `variables` is the set of top-level context keys the template, and any
+    template it includes, imports or extends, may read; it is None if that
+    can't be determined statically (e.g. the name of an included template is
+    computed).  `source_hash` is a hash of the source of all of those
+    templates.
+    """
+    if templates_dir is None:
+        templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
+    env = environment(templates_dir)
+    from jinja2 import meta
+    variables = set()
+    digest = hashlib.md5()
+    pending, seen = [source], set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        text = env.loader.get_source(env, name)[0]
+        digest.update(text.encode('utf-8'))
+        ast = env.parse(text)
+        if variables is not None:
+            variables.update(meta.find_undeclared_variables(ast))
+        for ref in meta.find_referenced_templates(ast):
+            if ref is None:
+                variables = None
+            else:
+                pending.append(ref)
+    return variables, digest.hexdigest()
+
+
+def _up_to_date(target, content, owner, group, perms):
+    """
+    Returns True if `target` already holds `content`, fixing its ownership
+    and permissions if those are all that differ.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if host.file_hash(target) != hashlib.md5(content).hexdigest():
+        return False
+    uid = pwd.getpwnam(owner).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    stat = os.stat(target)
+    if (stat.st_uid, stat.st_gid) != (uid, gid):
+        hookenv.log('Fixing ownership of {} {}:{}'.format(target, owner, group))
+        os.chown(target, uid, gid)
+    if stat.st_mode & 07777 != perms:
+        hookenv.log('Fixing permissions of {} {:o}'.format(target, perms))
+        os.chmod(target, perms)
+    return True
+
+
 def render(source, target, context, owner='root', group='root', perms=0444, templates_dir=None):
     """
     Render a template.
@@ -19,33 +124,25 @@ def render(source, target, context, owner='root', group='root', perms=0444, temp
 
     If omitted, `templates_dir` defaults to the `templates` folder in the charm.
 
+    The target is only written if the rendered content differs from what it
+    already holds.  Returns True if it was written, and False otherwise.
+
     Note: Using this requires python-jinja2; if it is not installed, calling
     this will attempt to use charmhelpers.fetch.apt_install to install it.
     """
-    try:
-        from jinja2 import FileSystemLoader, Environment, exceptions
-    except ImportError:
-        try:
-            from charmhelpers.fetch import apt_install
-        except ImportError:
-            hookenv.log('Could not import jinja2, and could not import '
-                        'charmhelpers.fetch to install it',
-                        level=hookenv.ERROR)
-            raise
-        apt_install('python-jinja2', fatal=True)
-        from jinja2 import FileSystemLoader, Environment, exceptions
-
     if templates_dir is None:
         templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
-    loader = Environment(loader=FileSystemLoader(templates_dir))
+    loader = environment(templates_dir)
     try:
-        source = source
         template = loader.get_template(source)
-    except exceptions.TemplateNotFound as e:
+    except _jinja2().exceptions.TemplateNotFound as e:
         hookenv.log('Could not load template %s from %s.' %
                     (source, templates_dir),
                     level=hookenv.ERROR)
         raise e
     content = template.render(context)
+    if _up_to_date(target, content, owner, group, perms):
+        return False
     host.mkdir(os.path.dirname(target))
     host.write_file(target, content, owner, group, perms)
+    return True
@@ -1,9 +1,14 @@
+import fcntl
 import importlib
 import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from yaml import safe_load
 from charmhelpers.core.host import (
     lsb_release
 )
+from charmhelpers.core import dpkg
 from urlparse import (
     urlparse,
     urlunparse,
@@ -74,8 +79,15 @@ FETCH_HANDLERS = (
 )
 
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
-APT_NO_LOCK_RETRY_DELAY = 10  # Wait 10 seconds between apt lock checks.
-APT_NO_LOCK_RETRY_COUNT = 30  # Retry to acquire the lock X times.
+APT_NO_LOCK_INITIAL_DELAY = 0.25  # First wait between apt lock checks.
+APT_NO_LOCK_RETRY_DELAY = 10  # Longest wait between apt lock checks.
+APT_NO_LOCK_TIMEOUT = 300  # Give up on the lock after this many seconds.
+APT_LOCK_FILES = (
+    '/var/lib/dpkg/lock-frontend',
+    '/var/lib/dpkg/lock',
+    '/var/lib/apt/lists/lock',
+    '/var/cache/apt/archives/lock',
+)
 
 
 class SourceConfigError(Exception):
@@ -115,7 +127,18 @@ class BaseFetchHandler(object):
 
 
 def filter_installed_packages(packages):
-    """Returns a list of packages that require installation"""
+    """Returns a list of packages that require installation
+
+    Installed packages are found from the dpkg status file; apt's cache is
+    only built to check the rest have an installation candidate.
+    """
+    try:
+        packages = [package for package in packages
+                    if not dpkg.is_installed(package)]
+    except (IOError, OSError, subprocess.CalledProcessError):
+        pass
+    if not packages:
+        return []
     import apt_pkg
     apt_pkg.init()
 
@@ -136,11 +159,95 @@ def filter_installed_packages(packages):
     return _pkgs
 
 
+class AptTransaction(object):
+    """
+    Install, purge and hold requests collected by `apt_transaction`, to be
+    run together by `apt_commit`.
+    """
+    def __init__(self):
+        self.installs = OrderedDict()  # options -> packages
+        self.purges = []
+        self.holds = []
+        self.fatal = {'install': False, 'purge': False, 'hold': False}
+
+    def add(self, operation, packages, fatal, options=None):
+        if isinstance(packages, basestring):
+            packages = [packages]
+        if operation == 'install':
+            queue = self.installs.setdefault(tuple(options), [])
+        else:
+            queue = self.purges if operation == 'purge' else self.holds
+        for package in packages:
+            if package not in queue:
+                queue.append(package)
+        self.fatal[operation] = self.fatal[operation] or fatal
+
+
+_transaction = None
+_transaction_lock = threading.RLock()
+
+
+@contextmanager
+def apt_transaction():
+    """
+    Collect the `apt_install`, `apt_purge` and `apt_hold` calls made in the
+    block, and run them when it ends, with one command for each operation
+    (and set of install options), skipping packages that are already
+    installed.  Nested transactions join the outermost one.
+
+    Code that needs its packages before the block ends can call
+    `apt_commit` to run what has been collected so far.  If the block
+    raises, the collected requests are discarded.
+    """
+    global _transaction
+    with _transaction_lock:
+        outermost = _transaction is None
+        if outermost:
+            _transaction = AptTransaction()
+    if not outermost:
+        yield _transaction
+        return
+    try:
+        yield _transaction
+        apt_commit()
+    finally:
+        with _transaction_lock:
+            _transaction = None
+
+
+def apt_commit():
+    """Run the requests collected by the current `apt_transaction`, if any"""
+    global _transaction
+    with _transaction_lock:
+        transaction = _transaction
+        if transaction is None:
+            return
+        _transaction = AptTransaction()
+    for options, packages in transaction.installs.items():
+        packages = filter_installed_packages(packages)
+        if packages:
+            _apt_install(packages, list(options), transaction.fatal['install'])
+    if transaction.purges:
+        _apt_purge(transaction.purges, transaction.fatal['purge'])
+    if transaction.holds:
+        _apt_hold(transaction.holds, transaction.fatal['hold'])
+
+
 def apt_install(packages, options=None, fatal=False):
-    """Install one or more packages"""
+    """Install one or more packages
+
+    Within an `apt_transaction`, the install is deferred to its commit.
+    """
     if options is None:
         options = ['--option=Dpkg::Options::=--force-confold']
+    with _transaction_lock:
+        if _transaction is not None:
+            _transaction.add('install', packages, fatal, options)
+            return
+    _apt_install(packages, options, fatal)
 
+
+def _apt_install(packages, options, fatal):
     cmd = ['apt-get', '--assume-yes']
     cmd.extend(options)
     cmd.append('install')
@@ -175,7 +282,18 @@ def apt_update(fatal=False):
 
 
 def apt_purge(packages, fatal=False):
-    """Purge one or more packages"""
+    """Purge one or more packages
+
+    Within an `apt_transaction`, the purge is deferred to its commit.
+    """
+    with _transaction_lock:
+        if _transaction is not None:
+            _transaction.add('purge', packages, fatal)
+            return
+    _apt_purge(packages, fatal)
+
+
+def _apt_purge(packages, fatal):
     cmd = ['apt-get', '--assume-yes', 'purge']
     if isinstance(packages, basestring):
         cmd.append(packages)
@@ -186,7 +304,18 @@ def apt_purge(packages, fatal=False):
 
 
 def apt_hold(packages, fatal=False):
-    """Hold one or more packages"""
+    """Hold one or more packages
+
+    Within an `apt_transaction`, the hold is deferred to its commit.
+    """
+    with _transaction_lock:
+        if _transaction is not None:
+            _transaction.add('hold', packages, fatal)
+            return
+    _apt_hold(packages, fatal)
+
+
+def _apt_hold(packages, fatal):
     cmd = ['apt-mark', 'hold']
     if isinstance(packages, basestring):
         cmd.append(packages)
@@ -320,7 +449,69 @@ def plugins(fetch_handlers=None):
     return plugin_list
 
 
-def _run_apt_command(cmd, fatal=False):
+def _apt_lock_holders():
+    """
+    Return a dict of the `APT_LOCK_FILES` that are locked to the PID holding
+    each, from /proc/locks.  If that can't be read, the locks are probed
+    with fcntl instead, and the PIDs are None.
+    """
+    files = {}
+    for path in APT_LOCK_FILES:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files[(os.major(stat.st_dev), os.minor(stat.st_dev), stat.st_ino)] = path
+    holders = {}
+    try:
+        with open('/proc/locks') as f:
+            for line in f:
+                # e.g. "1: POSIX  ADVISORY  WRITE 1234 fd:01:5678 0 EOF";
+                # processes waiting for a lock are marked with "->".
+                fields = line.split()
+                if '->' in fields or len(fields) < 6 or \
+                        fields[5].count(':') != 2:
+                    continue
+                major, minor, inode = fields[5].split(':')
+                path = files.get((int(major, 16), int(minor, 16), int(inode)))
+                if path:
+                    holders[path] = int(fields[4])
+    except IOError:
+        for path in files.values():
+            fd = os.open(path, os.O_RDWR)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            except IOError:
+                holders[path] = None
+            finally:
+                os.close(fd)
+    return holders
+
+
+def _wait_for_apt_lock(deadline, delay):
+    """
+    Wait `delay` seconds, then for as long as any of the apt locks are held,
+    checking again with exponential backoff.  Returns False if the locks
+    are still held at `deadline`.
+    """
+    reported = set()
+    while True:
+        if time.time() + delay > deadline:
+            return False
+        time.sleep(delay)
+        holders = _apt_lock_holders()
+        if not holders:
+            return True
+        for path, pid in holders.items():
+            if (path, pid) not in reported:
+                reported.add((path, pid))
+                log("Waiting for {} held by {}.".format(
+                    path, 'PID {}'.format(pid) if pid else 'another process'))
+        delay = min(delay * 2, APT_NO_LOCK_RETRY_DELAY)
+
+
+def _run_apt_command(cmd, fatal=False, lock_timeout=None):
     """
     Run an APT command, checking output and retrying if the fatal flag is set
     to True.
@@ -328,6 +519,8 @@ def _run_apt_command(cmd, fatal=False):
     :param: cmd: str: The apt command to run.
     :param: fatal: bool: Whether the command's output should be checked and
         retried.
+    :param: lock_timeout: int: How many seconds to keep retrying while the
+        dpkg lock is held; defaults to `APT_NO_LOCK_TIMEOUT`.
     """
     env = os.environ.copy()
 
@@ -335,23 +528,31 @@ def _run_apt_command(cmd, fatal=False):
         env['DEBIAN_FRONTEND'] = 'noninteractive'
 
     if fatal:
-        retry_count = 0
+        if lock_timeout is None:
+            lock_timeout = APT_NO_LOCK_TIMEOUT
+        deadline = time.time() + lock_timeout
+        delay = APT_NO_LOCK_INITIAL_DELAY
         result = None
 
         # If the command is considered "fatal", we need to retry if the apt
-        # lock was not acquired.
+        # lock was not acquired.  Any other failure ends the retries without
+        # raising, as it always has.
 
         while result is None or result == APT_NO_LOCK:
             try:
                 result = subprocess.check_call(cmd, env=env)
             except subprocess.CalledProcessError, e:
-                retry_count = retry_count + 1
-                if retry_count > APT_NO_LOCK_RETRY_COUNT:
-                    raise
                 result = e.returncode
-                log("Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(APT_NO_LOCK_RETRY_DELAY)
+                if result != APT_NO_LOCK:
+                    log("{} failed with exit code {}.".format(
+                        ' '.join(cmd), result))
+                    break
+                log("Couldn't acquire DPKG lock. Will retry until it is "
+                    "released, for up to {} seconds.".format(
+                        int(max(deadline - time.time(), 0))))
+                if not _wait_for_apt_lock(deadline, delay):
+                    raise e
+                delay = min(delay * 2, APT_NO_LOCK_RETRY_DELAY)
 
     else:
         subprocess.call(cmd, env=env)
@@ -1,15 +1,50 @@
 #!/usr/bin/env python
 
+import os
+import time
 import socket
+import struct
+from functools import partial
+from charmhelpers.core import host
 from charmhelpers.core import hookenv
 from charmhelpers.core import services
 from charmhelpers.contrib import docker
 
 
+DRIVER_PORT = 28015
+DRIVER_HANDSHAKE = struct.pack('<3I', 0x400c2d20, 0, 0x7e6970c7)  # V0_4, JSON
+
+
+def rethinkdb_probe(host, port=DRIVER_PORT, timeout=2):
+    """
+    Returns True if a RethinkDB server answers a client handshake on its
+    driver port at `host:port`.  Any reply, even one refusing the protocol
+    version, comes from the server itself; Docker's proxy for a published
+    port accepts the connection while nothing behind it is listening, but
+    then just closes it.
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except socket.error:
+        return False
+    try:
+        sock.sendall(DRIVER_HANDSHAKE)
+        return bool(sock.recv(1024))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
 class ClusterPeers(docker.DockerRelation):
     name = 'intracluster'
     interface = 'rethinkdb-cluster'
     port = 29015
+    persistent = True
+    join_strategy = docker.RendezvousJoin(limit=3, probe_port=DRIVER_PORT,
+                                          probe=rethinkdb_probe)
+    hot_reconfigure = True
+    visibility_timeout = 30
 
     def map(self, relation_settings):
         return [
@@ -19,6 +54,45 @@ class ClusterPeers(docker.DockerRelation):
             )
         ]
 
+    def reconfigure(self, added, removed):
+        """
+        RethinkDB servers share cluster membership: a new server joins a few
+        of its peers when it starts, and every server in the cluster then
+        connects to it, while departed servers are simply dropped.  So a
+        running server only needs a restart if new peers never become visible
+        to it.  This is checked through the `rethinkdb.server_status` admin
+        table if the RethinkDB driver is installed.  Without it, membership
+        can't be checked; the new peers are only checked to be answering as
+        RethinkDB servers, on the assumption that they then join this one.
+        """
+        addresses = set(settings['private-address'] for _, settings in added)
+        if not addresses:
+            return True
+        try:
+            import rethinkdb as r
+        except ImportError:
+            return all(rethinkdb_probe(address) for address in addresses)
+        deadline = time.time() + self.visibility_timeout
+        try:
+            conn = r.connect('localhost', DRIVER_PORT)
+            try:
+                while True:
+                    visible = set(
+                        address['host']
+                        for server in r.db('rethinkdb').table('server_status').run(conn)
+                        for address in server['network']['canonical_addresses'])
+                    if addresses <= visible:
+                        return True
+                    if time.time() > deadline:
+                        return False
+                    time.sleep(1)
+            finally:
+                conn.close()
+        except Exception as e:
+            hookenv.log('Could not check cluster membership: {}'.format(e),
+                        hookenv.WARNING)
+            return False
+
     def is_ready(self):
         return True  # Cluster is optional.
 
@@ -26,14 +100,51 @@ class ClusterPeers(docker.DockerRelation):
 class WebsiteRelation(services.helpers.RelationContext):
     name = 'website'
     interface = 'http'
+    persistent = True
 
     def provide_data(self):
         return {'hostname': hookenv.unit_private_ip(), 'port': 80}
 
 
+class StorageMount(services.ManagerCallback):
+    """
+    Mount `storage-device` at `storage-path`, with tuned options, before the
+    container starts.  If the mount is new, the running container still sees
+    the directory underneath it, so its recorded spec is dropped to have it
+    restarted.
+    """
+    def __call__(self, manager, service_name, event_name):
+        config = hookenv.config()
+        if not config['storage-device']:
+            return
+        device = config['storage-device']
+        filesystem = config['storage-filesystem']
+        mountpoint = storage_path()
+        mounted = host.mount_info(mountpoint) is not None
+        options = host.mount_options(
+            None if os.path.isdir(device) else filesystem,
+            config['storage-mount-options'])
+        if not host.ensure_mount(device, mountpoint, filesystem, options):
+            raise services.ServiceNotReady('Could not mount {} at {}'.format(
+                device, mountpoint))
+        if not mounted:
+            manager.state.delete(service_name, 'container_spec')
+
+
+def storage_path():
+    path = hookenv.config()['storage-path']
+    if not os.path.isabs(path):
+        path = os.path.join(hookenv.charm_dir(), path)
+    return path
+
+
+def image():
+    return docker.image_ref('dockerfile/rethinkdb', hookenv.config()['image-digest'])
+
+
 def install():
     docker.install_docker()
-    docker.docker_pull('dockerfile/rethinkdb')
+    docker.docker_pull(image())
 
 
 def manage():
@@ -41,6 +152,7 @@ def manage():
     manager = services.ServiceManager([
         {
             'service': 'dockerfile/rethinkdb',
+            'image': image(),
             'ports': [80, 28015, 29015],
             'provided_data': [WebsiteRelation()],
             'required_data': [
@@ -53,14 +165,25 @@ def manage():
                 docker.DockerContainerArgs(
                     'rethinkdb',
                     '--bind', 'all',
-                    '--canonical-address', hookenv.unit_get('public-address'),
-                    '--canonical-address', hookenv.unit_get('private-address'),
+                    '--canonical-address', partial(hookenv.unit_get, 'public-address'),
+                    '--canonical-address', partial(hookenv.unit_get, 'private-address'),
                     '--machine-name', socket.gethostname().replace('-', '_'),
                 ),
                 ClusterPeers(),
             ],
-            'start': docker.docker_start,
-            'stop': docker.docker_stop,
+            'start': [
+                StorageMount(),
+                docker.docker_start,
+                services.wait_for_ready(
+                    [(8080, 'http'), (28015, 'tcp'), (29015, 'tcp')],
+                    host=docker.container_address,
+                    timeout=config['readiness-timeout']),
+                services.open_ports,
+            ],
+            'stop': [
+                services.close_ports,
+                docker.docker_stop,
+            ],
         },
     ])
     manager.manage()